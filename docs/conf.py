@@ -290,7 +290,7 @@ texinfo_documents = [
 #texinfo_no_detailmenu = False
 
 intersphinx_mapping = {
-    'python': ('http://docs.python.org/3.5', None),
+    'python': ('https://docs.python.org/3', None),
     'pytest': ('http://docs.pytest.org/en/latest/', None),
     'py.path': ('http://py.readthedocs.io/en/latest/', None),
     'pythonrtd': ('http://python.readthedocs.org/en/latest/', None),
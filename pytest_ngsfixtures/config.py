@@ -8,6 +8,12 @@ from pytest_ngsfixtures import DATA_DIR
 REF_DIR = DATA_DIR / "ref"
 SAMPLES_DIR = DATA_DIR / "seq"
 
+# Persistent cache directory shared between sessions
+CACHE_DIR = pathlib.Path(os.environ.get(
+    "PYTEST_NGSFIXTURES_CACHE",
+    os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                 "pytest-ngsfixtures")))
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+"""Docker client and container helpers for pytest-ngsfixtures.
+
+A single docker client is shared by all callers in a process. The
+client keeps a pool of HTTP connections to the docker daemon and
+negotiates the API version once, instead of once per command. The
+client is recreated automatically after a fork (e.g. in pytest-xdist
+workers) and when a periodic health check fails.
+"""
+import os
+import json
+import time
+import threading
+import contextlib
+import concurrent.futures
+import docker
+import logging
+from pytest_ngsfixtures import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+MAX_POOL_SIZE = max(10, os.cpu_count() or 1)
+HEALTH_INTERVAL = 30.0
+POOL_SIZE = 4
+POOL_IDLE_TIMEOUT = 300.0
+POOL_LABEL = "pytest_ngsfixtures.pool"
+REGISTRY = os.environ.get("PYTEST_NGSFIXTURES_REGISTRY")
+
+_client = None
+_client_pid = None
+_client_checked = 0.0
+_client_lock = threading.Lock()
+_images = {}
+_images_lock = threading.Lock()
+
+
+def _healthy(client):
+    try:
+        return client.ping()
+    except Exception as e:
+        logger.warning("docker client health check failed: {}".format(e))
+        return False
+
+
+def get_client(health_interval=HEALTH_INTERVAL):
+    """Return the process-wide docker client.
+
+    The client is created lazily from the environment on first use.
+    Connections inherited from a parent process are never reused;
+    instead a new client is created in the child.
+
+    Args:
+      health_interval (float): seconds after which the daemon is
+                               pinged before handing out the client
+                               again; a failed ping recreates the
+                               client
+
+    Examples:
+
+      .. code-block:: python
+
+         from pytest_ngsfixtures.container import get_client
+         image = get_client().images.get("busybox:latest")
+    """
+    global _client, _client_pid, _client_checked
+    with _client_lock:
+        now = time.monotonic()
+        if _client is not None and _client_pid != os.getpid():
+            # Sockets are shared with the parent; leave them alone
+            logger.debug("discarding docker client inherited from pid {}".format(_client_pid))
+            _client = None
+        elif _client is not None and now - _client_checked > health_interval:
+            if not _healthy(_client):
+                _close(_client)
+                _client = None
+            _client_checked = now
+        if _client is None:
+            _client = docker.from_env(max_pool_size=MAX_POOL_SIZE)
+            _client_pid = os.getpid()
+            _client_checked = now
+        return _client
+
+
+def _close(client):
+    try:
+        client.close()
+    except Exception:
+        pass
+
+
+def reset():
+    """Close and forget the process-wide docker client"""
+    global _client
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _close(_client)
+        _client = None
+
+
+def uses_images(*names):
+    """Declare the docker images a fixture depends on.
+
+    The plugin pulls the images of all fixtures and ngs_image markers
+    used by the collected tests before the first test runs.
+
+    Examples:
+
+      .. code-block:: python
+
+         @pytest.fixture(scope="session")
+         @uses_images("busybox:latest")
+         def busybox_image():
+             return get_image("busybox:latest")
+    """
+    def decorate(func):
+        func.ngs_images = getattr(func, "ngs_images", ()) + tuple(names)
+        return func
+    return decorate
+
+
+def _mirror(repository, registry):
+    """Return repository name on registry, dropping any registry host"""
+    parts = repository.split("/", 1)
+    if len(parts) == 2 and ("." in parts[0] or ":" in parts[0] or parts[0] == "localhost"):
+        repository = parts[1]
+    return "{}/{}".format(registry.rstrip("/"), repository)
+
+
+def _pull(name, registry=None):
+    client = get_client()
+    repository, tag = docker.utils.parse_repository_tag(name)
+    tag = tag or "latest"
+    if registry:
+        mirror = _mirror(repository, registry)
+        logger.info("pulling docker image '{}' from '{}'".format(name, mirror))
+        image = client.images.pull(mirror, tag=tag)
+        image.tag(repository, tag)
+    else:
+        logger.info("docker image '{}' not found; pulling".format(name))
+        image = client.images.pull(repository, tag=tag)
+    return image
+
+
+def get_image(name, pull=True, registry=None):
+    """Return image name, pulling it if it is not present.
+
+    Resolved images are cached for the lifetime of the process, so
+    that repeated lookups do not hit the docker daemon.
+
+    Args:
+      name (str): image name
+      pull (bool): pull image if missing; otherwise raise ImageNotFound
+      registry (str): registry mirror to pull from, e.g.
+                      'localhost:5000'; defaults to the
+                      PYTEST_NGSFIXTURES_REGISTRY environment variable
+    """
+    with _images_lock:
+        if name in _images:
+            return _images[name]
+    try:
+        image = get_client().images.get(name)
+        logger.info("retrieved local image '{}'".format(name))
+    except docker.errors.ImageNotFound:
+        if not pull:
+            raise
+        image = _pull(name, registry or REGISTRY)
+    with _images_lock:
+        _images[name] = image
+    return image
+
+
+def pull_images(names, max_workers=4, registry=None):
+    """Resolve and pull images concurrently.
+
+    Args:
+      names (iterable): image names
+      max_workers (int): maximum number of concurrent pulls
+      registry (str): registry mirror; see :py:func:`get_image`
+
+    Returns:
+      dict mapping image names to images, or to the exception raised
+      while resolving the image
+    """
+    with _images_lock:
+        names = sorted(set(names) - set(_images))
+    if not names:
+        return {}
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(get_image, n, registry=registry): n for n in names}
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[f]] = f.result()
+            except docker.errors.DockerException as e:
+                logger.warning("failed to pull docker image '{}': {}".format(futures[f], e))
+                results[futures[f]] = e
+    return results
+
+
+def _within(path, parent):
+    return path == parent or path.startswith(parent.rstrip(os.sep) + os.sep)
+
+
+def bind_mounts(paths, mode="rw", data_dir=DATA_DIR):
+    """Return the minimal docker volume specification covering paths.
+
+    Every path is mounted at the same location inside the container.
+    Files contribute their parent directory, and directories nested
+    in another mounted directory are collapsed into it. The package
+    data directory is always mounted read-only, so that fixture
+    symlinks into it resolve inside the container; paths within it
+    are never mounted writable.
+
+    Args:
+      paths (list): files and directories, e.g. samples, ref and snakefile fixtures
+      mode (str): mount mode of paths
+      data_dir (str): package data directory
+
+    Returns:
+      dict suitable for the volumes argument of :py:meth:`docker.models.containers.ContainerCollection.run`
+
+    Examples:
+
+      .. code-block:: python
+
+         shell("snakemake -s {}".format(snakefile), image=snakemake_image,
+               volumes=bind_mounts([snakefile, samples]))
+    """
+    data_dirs = {os.path.abspath(str(data_dir)), os.path.realpath(str(data_dir))}
+    wanted = {d: "ro" for d in data_dirs}
+    for p in paths:
+        p = os.path.abspath(str(p))
+        if not os.path.isdir(p):
+            p = os.path.dirname(p)
+        if any(_within(p, d) for d in data_dirs):
+            continue
+        if wanted.get(p) != "rw":
+            wanted[p] = mode
+    volumes = {}
+    # Parents sort before their children; a child is covered by a
+    # parent unless it needs write access the parent does not grant
+    for p in sorted(wanted):
+        if any(_within(p, q) and (v['mode'] == "rw" or wanted[p] == "ro")
+               for q, v in volumes.items()):
+            continue
+        volumes[p] = {'bind': p, 'mode': wanted[p]}
+    return volumes
+
+
+def resource_limits(cores=None, mem_mb=None, cpus=None, update=False):
+    """Return docker CPU and memory constraints.
+
+    Args:
+      cores (float): number of CPUs the container may use
+      mem_mb (int): memory limit in megabytes; swap is disabled
+      cpus (list): CPUs to pin the container to
+      update (bool): return arguments for
+                     :py:meth:`~docker.models.containers.Container.update`,
+                     which does not support nano_cpus, instead of
+                     arguments for creating a container
+
+    Returns:
+      dict of keyword arguments
+    """
+    kwargs = {}
+    if cpus:
+        kwargs['cpuset_cpus'] = ",".join(str(c) for c in cpus)
+    if cores:
+        if update:
+            kwargs['cpu_period'] = 100000
+            kwargs['cpu_quota'] = int(cores * 100000)
+        else:
+            kwargs['nano_cpus'] = int(cores * 1e9)
+    if mem_mb:
+        kwargs['mem_limit'] = kwargs['memswap_limit'] = "{}m".format(int(mem_mb))
+    return kwargs
+
+
+def apply_limits(container, **limits):
+    """Update the constraints of a running container, if any"""
+    if not limits:
+        return
+    try:
+        container.update(**limits)
+    except docker.errors.APIError as e:
+        logger.warning("failed to set resource limits on container {}: {}".format(
+            container.short_id, e))
+
+
+def _running(container):
+    try:
+        container.reload()
+    except docker.errors.APIError:
+        return False
+    return container.status == "running"
+
+
+def _remove(container):
+    try:
+        container.remove(force=True)
+        logger.info("Removed container {} ({})".format(container.name, container.short_id))
+    except docker.errors.APIError as e:
+        logger.warning("failed to remove container {}: {}".format(container.short_id, e))
+
+
+class ContainerPool:
+    """Pool of started, idle containers for running commands via exec.
+
+    Containers are keyed on the image and the arguments they were
+    started with (e.g. user and volumes), and keep running an idle
+    shell between commands. Idle containers are health checked before
+    they are handed out and removed once they have been idle for more
+    than idle_timeout seconds. Containers that are leased out are
+    tracked as well, so that closing the pool removes containers that
+    were never released.
+
+    Args:
+      size (int): maximum number of idle containers kept per key
+      idle_timeout (float): seconds after which idle containers are removed
+
+    Examples:
+
+      .. code-block:: python
+
+         pool = ContainerPool(size=2)
+         with pool.lease("busybox:latest", user="1000:1000") as c:
+             c.exec_run("ls", workdir="/tmp")
+         pool.close()
+    """
+    def __init__(self, size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._leased = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(image, run_kwargs):
+        image = getattr(image, "id", image)
+        return (image, json.dumps(run_kwargs, sort_keys=True, default=str))
+
+    def _start(self, image, run_kwargs):
+        kwargs = dict(run_kwargs)
+        kwargs.update(entrypoint=["/bin/sh"], command=None, tty=True,
+                      stdin_open=True, detach=True,
+                      labels={POOL_LABEL: str(os.getpid())})
+        container = get_client().containers.run(image, **kwargs)
+        logger.info("started pooled container {} from image {}".format(container.short_id, image))
+        return container
+
+    def acquire(self, image, **run_kwargs):
+        """Return a running container for image, starting one if none is idle.
+
+        Args:
+          image (str, Image): image name or instance
+          run_kwargs (dict): arguments to :py:meth:`docker.models.containers.ContainerCollection.run`
+        """
+        self.evict()
+        key = self._key(image, run_kwargs)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                container = idle.pop()[0] if idle else None
+            if container is None:
+                container = self._start(image, run_kwargs)
+            elif not _running(container):
+                logger.warning("pooled container {} is not running; replacing".format(container.short_id))
+                _remove(container)
+                continue
+            with self._lock:
+                self._leased[id(container)] = container
+            return container
+
+    def release(self, container, image, **run_kwargs):
+        """Return container to the pool, or remove it if the pool is full"""
+        key = self._key(image, run_kwargs)
+        with self._lock:
+            if self._leased.pop(id(container), None) is None:
+                # Removed when the pool was closed
+                return
+        if _running(container):
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.size:
+                    idle.append((container, time.monotonic()))
+                    return
+        _remove(container)
+
+    @contextlib.contextmanager
+    def lease(self, image, **run_kwargs):
+        """Context manager around :py:meth:`acquire` and :py:meth:`release`"""
+        container = self.acquire(image, **run_kwargs)
+        try:
+            yield container
+        finally:
+            self.release(container, image, **run_kwargs)
+
+    def evict(self, idle_timeout=None):
+        """Remove containers that have been idle for more than idle_timeout seconds"""
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                expired.extend(c for c, t in idle if now - t > idle_timeout)
+                idle[:] = [(c, t) for c, t in idle if now - t <= idle_timeout]
+        for container in expired:
+            _remove(container)
+
+    def close(self):
+        """Remove all idle and leased containers"""
+        self.evict(idle_timeout=-1)
+        with self._lock:
+            leased, self._leased = list(self._leased.values()), {}
+        for container in leased:
+            _remove(container)
+
+
+_pool = None
+_pool_pid = None
+
+
+def configure_pool(size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+    """Setup the process-wide container pool, closing any previous pool"""
+    global _pool, _pool_pid
+    close_pool()
+    _pool = ContainerPool(size=size, idle_timeout=idle_timeout)
+    _pool_pid = os.getpid()
+    return _pool
+
+
+def get_pool():
+    """Return the process-wide container pool, creating it if needed.
+
+    Containers pooled by a parent process are not shared with forked
+    children; each process starts its own.
+    """
+    if _pool is None or _pool_pid != os.getpid():
+        return configure_pool()
+    return _pool
+
+
+def close_pool():
+    """Remove the idle containers of the process-wide container pool"""
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.close()
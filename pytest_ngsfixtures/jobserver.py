@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""Machine-wide resource token pool for pytest-ngsfixtures.
+
+The job server plays the same role as the GNU make jobserver: every
+participating process (pytest itself, xdist workers, or separate
+pytest sessions on the same machine) draws tokens from a shared pool
+before launching a command, and returns them once the command has
+finished. The pool state lives in a small JSON file protected by an
+exclusive file lock, and allocations of processes that have died are
+reclaimed automatically.
+"""
+import os
+import json
+import math
+import time
+import fcntl
+import tempfile
+import threading
+import contextlib
+import contextvars
+import logging
+
+logger = logging.getLogger(__name__)
+
+JOBSERVER_PATH = os.environ.get(
+    "PYTEST_NGSFIXTURES_JOBSERVER",
+    os.path.join(tempfile.gettempdir(),
+                 "pytest-ngsfixtures-{}.jobserver".format(os.getuid())))
+
+
+def _cpu_ids():
+    """Return the CPUs this process may run on"""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobServer:
+    """Token pool shared between processes via a locked state file.
+
+    Cores are handed out as specific CPUs, so that concurrent holders
+    get disjoint CPU sets that can be used for pinning, e.g. as
+    container cpusets.
+
+    Reservations nest per execution context: tokens drawn in a thread
+    or asyncio task cover later requests made from the same thread or
+    task (and from contexts copied from it, see
+    :py:func:`contextvars.copy_context`), but not requests made by
+    unrelated threads. Nested requests are debited from the remaining
+    amount of the enclosing reservation, so that sibling contexts
+    copied from the same context share its reservation as a budget,
+    and only the shortfall is drawn from the pool.
+
+    Args:
+      budget (dict): mapping from resource name to capacity, e.g. {'cores': 16}
+      path (str): state file path; processes sharing a path share a pool
+      poll (float): seconds to sleep between acquisition attempts
+
+    Examples:
+
+      .. code-block:: python
+
+         js = JobServer({'cores': 4})
+         with js.reserve(cores=2) as waited:
+             shell("bwa mem -t 2 ...")
+    """
+    def __init__(self, budget, path=JOBSERVER_PATH, poll=0.1):
+        self.budget = dict(budget)
+        self.path = str(path)
+        self.poll = poll
+        self.waited = 0.0
+        self._context = contextvars.ContextVar("jobserver-{}".format(id(self)), default=())
+        self._tokens = {}
+        self._cpus = _cpu_ids()
+        self._lock = threading.Lock()
+        self._count = 0
+
+    @contextlib.contextmanager
+    def _locked_state(self):
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path) as fh:
+                        state = json.load(fh)
+                except (OSError, ValueError):
+                    state = {}
+                state = {k: v for k, v in state.items() if _pid_alive(v['pid'])}
+                yield state
+                tmp = "{}.{}".format(self.path, os.getpid())
+                with open(tmp, "w") as fh:
+                    json.dump(state, fh)
+                os.replace(tmp, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _clamp(self, request):
+        resources = {}
+        for k, v in request.items():
+            if not v:
+                continue
+            if k not in self.budget:
+                logger.debug("no budget for resource '{}'; ignoring".format(k))
+                continue
+            if v > self.budget[k]:
+                logger.warning("requested {}={} exceeds budget {}; clamping".format(k, v, self.budget[k]))
+                v = self.budget[k]
+            resources[k] = v
+        return resources
+
+    def _try_acquire(self, token, resources):
+        """Draw resources from the pool; return the CPUs drawn, or None"""
+        with self._locked_state() as state:
+            for k, v in resources.items():
+                used = sum(h['resources'].get(k, 0) for h in state.values())
+                if used + v > self.budget[k]:
+                    return None
+            cpus = []
+            if resources.get('cores'):
+                used = {c for h in state.values() for c in h.get('cpus', [])}
+                free = [i for i in range(int(self.budget['cores'])) if i not in used]
+                cpus = free[:math.ceil(resources['cores'])]
+            state[token] = {'pid': os.getpid(), 'resources': resources, 'cpus': cpus}
+        return [self._cpus[i % len(self._cpus)] for i in cpus]
+
+    def _live(self):
+        """Return the tokens held by the calling context; call with the
+        lock held"""
+        return tuple(t for t in self._context.get() if t in self._tokens)
+
+    def _debit(self, resources):
+        """Debit resources from the reservations of the calling context.
+
+        Reservations are debited innermost first.
+
+        Returns:
+          tuple of the list of debits and the shortfall left to draw
+          from the pool
+        """
+        shortfall, debits = dict(resources), []
+        with self._lock:
+            for t in reversed(self._live()):
+                a = self._tokens[t]
+                debit = {k: min(v, a['free'].get(k, 0)) for k, v in shortfall.items()}
+                debit = {k: v for k, v in debit.items() if v > 0}
+                if not debit:
+                    continue
+                cpus = []
+                if debit.get('cores'):
+                    cpus = a['free_cpus'][:math.ceil(debit['cores'])]
+                    del a['free_cpus'][:len(cpus)]
+                for k, v in debit.items():
+                    a['free'][k] -= v
+                    shortfall[k] -= v
+                debits.append((t, debit, cpus))
+        return debits, {k: v for k, v in shortfall.items() if v > 0}
+
+    def _credit(self, debits):
+        """Return debits to the reservations they were drawn from"""
+        with self._lock:
+            for t, debit, cpus in debits:
+                a = self._tokens.get(t)
+                if a is None:
+                    continue
+                for k, v in debit.items():
+                    a['free'][k] += v
+                a['free_cpus'] = sorted(a['free_cpus'] + cpus)
+
+    def held(self):
+        """Return the resources of the innermost reservation of the
+        calling context not passed on to nested reservations"""
+        return self.allocation()['resources']
+
+    def acquire(self, **request):
+        """Block until the requested resources are available.
+
+        Requests are first debited from the reservations of the calling
+        context, and only the shortfall is drawn from the pool, so that
+        nested calls (e.g. shell inside snakemake.run) do not deadlock
+        or draw twice, and concurrent nested calls (e.g. the commands
+        of shell.map) do not oversubscribe the enclosing reservation.
+
+        Returns:
+          token (str): token to pass to :py:meth:`release`, or None if nothing was requested
+        """
+        request = self._clamp(request)
+        if not request:
+            return None
+        with self._lock:
+            self._count += 1
+            token = "{}:{}".format(os.getpid(), self._count)
+        start, waited = time.monotonic(), 0.0
+        while True:
+            debits, shortfall = self._debit(request)
+            cpus = self._try_acquire(token, shortfall) if shortfall else []
+            if cpus is not None:
+                break
+            # Return debits while waiting so that siblings can proceed
+            self._credit(debits)
+            time.sleep(self.poll)
+            waited = time.monotonic() - start
+        if waited:
+            logger.info("waited {:.2f}s for {}".format(waited, request))
+        cpus = sorted(set(cpus).union(*(d[2] for d in debits)))
+        with self._lock:
+            self.waited += waited
+            self._tokens[token] = {'resources': request, 'cpus': cpus,
+                                   'free': dict(request), 'free_cpus': list(cpus),
+                                   'drawn': shortfall, 'debits': debits}
+            self._context.set(self._live() + (token,))
+        return token
+
+    def release(self, token):
+        """Return the resources drawn with token to the pool, or to the
+        reservation they were debited from"""
+        if token is None:
+            return
+        with self._lock:
+            a = self._tokens.pop(token, None)
+        if a is None:
+            return
+        if a['drawn']:
+            with self._locked_state() as state:
+                state.pop(token, None)
+        self._credit(a['debits'])
+
+    def allocation(self, token=None):
+        """Return resources and CPUs drawn with token.
+
+        Args:
+          token (str): token returned by :py:meth:`acquire`; if None,
+                       return what the innermost reservation of the
+                       calling context has not passed on to nested
+                       reservations
+
+        Returns:
+          dict with keys 'resources' and 'cpus'
+        """
+        with self._lock:
+            if token is not None:
+                a = self._tokens.get(token, {'resources': {}, 'cpus': []})
+                return {'resources': dict(a['resources']), 'cpus': list(a['cpus'])}
+            live = self._live()
+            if not live:
+                return {'resources': {}, 'cpus': []}
+            a = self._tokens[live[-1]]
+            return {'resources': {k: v for k, v in a['free'].items() if v > 0},
+                    'cpus': list(a['free_cpus'])}
+
+    @contextlib.contextmanager
+    def reserve(self, **request):
+        """Context manager around :py:meth:`acquire` and :py:meth:`release`"""
+        waited = self.waited
+        token = self.acquire(**request)
+        try:
+            yield self.waited - waited
+        finally:
+            self.release(token)
+
+    def queue_time(self, reset=False):
+        """Return accumulated seconds spent waiting for tokens"""
+        with self._lock:
+            waited = self.waited
+            if reset:
+                self.waited = 0.0
+        return waited
+
+
+_jobserver = None
+
+
+def configure(budget, path=JOBSERVER_PATH, **kwargs):
+    """Setup the process-wide job server used by shell and snakemake.run"""
+    global _jobserver
+    _jobserver = JobServer(budget, path=path, **kwargs)
+    return _jobserver
+
+
+def get_jobserver():
+    """Return the process-wide job server, or None if not configured"""
+    return _jobserver
+
+
+def acquire(**request):
+    """Acquire resources from the process-wide job server, if any"""
+    if _jobserver is None:
+        return None
+    return _jobserver.acquire(**request)
+
+
+def release(token):
+    """Release token to the process-wide job server, if any"""
+    if _jobserver is None:
+        return
+    _jobserver.release(token)
+
+
+def held():
+    """Return the resources currently reserved by the calling context"""
+    if _jobserver is None:
+        return {}
+    return _jobserver.held()
+
+
+def allocation(token=None):
+    """Return resources and CPUs held by token, or by the calling
+    context if token is None; see :py:meth:`JobServer.allocation`"""
+    if _jobserver is None:
+        return {'resources': {}, 'cpus': []}
+    return _jobserver.allocation(token)
+
+
+def pack(requests, budget):
+    """Order resource requests so that consecutive requests fit the budget.
+
+    Requests are packed first-fit decreasing into bins whose capacity
+    is the budget, and the bins are returned in order. Running the
+    requests in the returned order therefore tends to mix heavy and
+    light requests such that neighbours can run concurrently.
+
+    Args:
+      requests (list): list of resource dictionaries
+      budget (dict): resource name to capacity mapping
+
+    Returns:
+      list of indices into requests
+    """
+    def size(i):
+        return max([v / budget[k] for k, v in requests[i].items() if budget.get(k)] or [0])
+
+    bins = []
+    for i in sorted(range(len(requests)), key=size, reverse=True):
+        for b in bins:
+            if all(b['used'].get(k, 0) + v <= budget[k]
+                   for k, v in requests[i].items() if budget.get(k)):
+                break
+        else:
+            b = {'used': {}, 'members': []}
+            bins.append(b)
+        for k, v in requests[i].items():
+            b['used'][k] = b['used'].get(k, 0) + v
+        b['members'].append(i)
+    return [i for b in bins for i in b['members']]
+
+
+def queue_time(reset=False):
+    """Return time spent waiting on the process-wide job server"""
+    if _jobserver is None:
+        return 0.0
+    return _jobserver.queue_time(reset=reset)
@@ -2,12 +2,45 @@
 """Plugin configuration module for pytest-ngsfixtures"""
 import os
 import re
+import shutil
+import logging
+import tempfile
+import importlib
+import functools
 import pytest
 from py._path.local import LocalPath
 from pytest_ngsfixtures.config import layout, reflayout
 from pytest_ngsfixtures.os import safe_mktemp, safe_copy, safe_symlink
+from pytest_ngsfixtures import jobserver
+from pytest_ngsfixtures.wm import cache, benchmark
+
+logger = logging.getLogger(__name__)
 
 _help_ngs_threads = "set the number of threads to use in test"
+_help_ngs_cores = "machine-wide core budget shared by all pytest processes via the job server"
+_help_ngs_mem_mb = "machine-wide memory budget (MB) for tests marked with ngs_resources"
+_help_ngs_disk_mb = "machine-wide temporary disk budget (MB) for tests marked with ngs_resources"
+_help_ngs_registry = "docker registry mirror to pull images from, e.g. localhost:5000"
+_help_ngs_conda_create_envs = "create the conda environments of all snakefiles used in the session before running tests"
+_help_ngs_pool_size = "number of idle containers kept per image for shell(..., pool=True)"
+_help_ngs_no_cache = "re-execute workflows run with snakemake.run(..., cache=True) instead of restoring cached outputs"
+_help_ngs_cache_max_mb = "size cap (MB) of the workflow output cache"
+
+
+@functools.lru_cache(maxsize=None)
+def _optional(name):
+    """Import and return pytest_ngsfixtures submodule name, or None if
+    its optional dependencies (e.g. docker) are not installed"""
+    try:
+        return importlib.import_module("pytest_ngsfixtures." + name)
+    except ImportError as e:
+        logger.debug("pytest_ngsfixtures.{} not available: {}".format(name, e))
+        return None
+
+
+def _usage(reset=False):
+    shell_module = _optional("shell")
+    return shell_module.usage(reset=reset) if shell_module is not None else []
 
 
 def pytest_addoption(parser):
@@ -20,10 +53,270 @@ def pytest_addoption(parser):
         default=1,
         help=_help_ngs_threads,
     )
+    group.addoption(
+        '--ngs-cores',
+        action="store",
+        dest="ngs_cores",
+        type=int,
+        default=os.cpu_count(),
+        help=_help_ngs_cores,
+    )
+    group.addoption(
+        '--ngs-mem-mb',
+        action="store",
+        dest="ngs_mem_mb",
+        type=int,
+        default=os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 2**20,
+        help=_help_ngs_mem_mb,
+    )
+    group.addoption(
+        '--ngs-disk-mb',
+        action="store",
+        dest="ngs_disk_mb",
+        type=int,
+        default=shutil.disk_usage(tempfile.gettempdir()).free // 2**20,
+        help=_help_ngs_disk_mb,
+    )
+    group.addoption(
+        '--ngs-registry',
+        action="store",
+        dest="ngs_registry",
+        default=None,
+        help=_help_ngs_registry,
+    )
+    group.addoption(
+        '--ngs-conda-create-envs',
+        action="store_true",
+        dest="ngs_conda_create_envs",
+        default=False,
+        help=_help_ngs_conda_create_envs,
+    )
+    group.addoption(
+        '--ngs-pool-size',
+        action="store",
+        dest="ngs_pool_size",
+        type=int,
+        default=None,
+        help=_help_ngs_pool_size,
+    )
+    group.addoption(
+        '--ngs-no-cache',
+        action="store_true",
+        dest="ngs_no_cache",
+        default=False,
+        help=_help_ngs_no_cache,
+    )
+    group.addoption(
+        '--ngs-cache-max-mb',
+        action="store",
+        dest="ngs_cache_max_mb",
+        type=int,
+        default=cache.MAX_MB,
+        help=_help_ngs_cache_max_mb,
+    )
 
 
 def pytest_configure(config):
-    pass
+    config.addinivalue_line("markers",
+                            "ngs_resources(threads=1, mem_mb=0, disk_mb=0): "
+                            "reserve machine resources for the duration of the test")
+    config.addinivalue_line("markers",
+                            "ngs_image(*names): docker images to pull before the session starts")
+    config.addinivalue_line("markers",
+                            "ngs_perf(rule, max_s=None, max_rss_mb=None): fail if a workflow "
+                            "rule run in the test exceeds the running time or memory thresholds")
+    shell_module = _optional("shell")
+    if shell_module is not None:
+        shell_module.shell.threads(config.getoption("ngs_threads"))
+    jobserver.configure({
+        'cores': config.getoption("ngs_cores"),
+        'mem_mb': config.getoption("ngs_mem_mb"),
+        'disk_mb': config.getoption("ngs_disk_mb"),
+    })
+    container = _optional("container")
+    if container is not None and config.getoption("ngs_pool_size") is not None:
+        container.configure_pool(size=config.getoption("ngs_pool_size"))
+    cache.configure(enabled=not config.getoption("ngs_no_cache"),
+                    max_mb=config.getoption("ngs_cache_max_mb"))
+
+
+def pytest_unconfigure(config):
+    container = _optional("container")
+    if container is not None:
+        container.close_pool()
+
+
+def _resources(item):
+    """Return resources declared with pytest.mark.ngs_resources"""
+    mark = item.get_closest_marker("ngs_resources")
+    if mark is None:
+        return None
+    d = {'threads': 1, 'mem_mb': 0, 'disk_mb': 0}
+    d.update(mark.kwargs)
+    return {'cores': d['threads'], 'mem_mb': d['mem_mb'], 'disk_mb': d['disk_mb']}
+
+
+def pytest_collection_modifyitems(session, config, items):
+    """Pack tests declaring resources so that neighbours fit the budget.
+
+    Only tests marked with ngs_resources are moved, and only among
+    the positions they already occupy.
+    """
+    js = jobserver.get_jobserver()
+    marked = [i for i, item in enumerate(items) if _resources(item) is not None]
+    if js is None or len(marked) < 2:
+        return
+    order = jobserver.pack([_resources(items[i]) for i in marked], js.budget)
+    packed = [items[marked[i]] for i in order]
+    for i, item in zip(marked, packed):
+        items[i] = item
+
+
+def _images(item):
+    """Return docker images declared by markers and fixtures of item"""
+    names = set()
+    for mark in item.iter_markers("ngs_image"):
+        names.update(mark.args)
+    fixtureinfo = getattr(item, "_fixtureinfo", None)
+    if fixtureinfo is not None:
+        for fixturedefs in fixtureinfo.name2fixturedefs.values():
+            for fixturedef in fixturedefs:
+                names.update(getattr(fixturedef.func, "ngs_images", ()))
+    return names
+
+
+def _snakefile(item):
+    """Return the source snakefile used by the snakefile fixture of item"""
+    if "snakefile" not in getattr(item, "fixturenames", ()):
+        return None
+    mark = item.get_closest_marker("snakefile")
+    if mark is not None and "snakefile" in mark.kwargs:
+        return str(mark.kwargs["snakefile"])
+    return os.path.join(str(item.fspath.dirname), "Snakefile")
+
+
+def pytest_collection_finish(session):
+    """Pull the docker images used by the collected tests concurrently,
+    and create the conda environments of the snakefiles they use if
+    requested"""
+    if session.config.getoption("collectonly"):
+        return
+    names = set()
+    for item in session.items:
+        names.update(_images(item))
+    container = _optional("container")
+    if names and container is None:
+        logger.warning("docker is not installed; not pulling images {}".format(", ".join(sorted(names))))
+    elif names:
+        container.pull_images(names, registry=session.config.getoption("ngs_registry"))
+    if session.config.getoption("ngs_conda_create_envs"):
+        from pytest_ngsfixtures.wm import snakemake
+        snakefiles = {_snakefile(item) for item in session.items} - {None}
+        snakemake.create_conda_envs([f for f in snakefiles if os.path.exists(f)])
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtest_setup(item):
+    jobserver.queue_time(reset=True)
+    _usage(reset=True)
+    benchmark.metrics(reset=True)
+    resources = _resources(item)
+    if resources is not None:
+        item._ngs_token = jobserver.acquire(**resources)
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_runtest_teardown(item, nextitem):
+    jobserver.release(getattr(item, "_ngs_token", None))
+    item._ngs_token = None
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_runtest_call(item):
+    """Check workflow rule metrics against ngs_perf thresholds once
+    the test has passed"""
+    marks = list(item.iter_markers("ngs_perf"))
+    if not marks:
+        return
+    metrics = benchmark.metrics()
+    errors = []
+    for mark in marks:
+        d = dict(zip(("rule", "max_s", "max_rss_mb"), mark.args))
+        d.update(mark.kwargs)
+        errors += benchmark.check(metrics, **d)
+    if errors:
+        pytest.fail("\n".join(errors), pytrace=False)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    """Attach job server queueing time, command usage and rule metrics
+    of the test to its report; properties without data are left out"""
+    if call.when == "call":
+        for name, value in (("ngs_queue_time", jobserver.queue_time(reset=True)),
+                            ("ngs_usage", [tuple(u) for u in _usage(reset=True)]),
+                            ("ngs_rule_metrics", benchmark.metrics(reset=True))):
+            if value:
+                item.user_properties.append((name, value))
+    yield
+
+
+def _fmt(value, fmt):
+    return "-" if value is None else fmt.format(value)
+
+
+def pytest_terminal_summary(terminalreporter):
+    queued = []
+    commands = []
+    for reports in terminalreporter.stats.values():
+        for r in reports:
+            if getattr(r, "when", None) != "call":
+                continue
+            props = dict(getattr(r, "user_properties", []))
+            waited = props.get("ngs_queue_time", 0.0)
+            if waited > 0.5:
+                queued.append((waited, r.nodeid))
+            for cmd, elapsed, utime, stime, maxrss in props.get("ngs_usage", []):
+                commands.append((elapsed, utime, stime, maxrss, cmd, r.nodeid))
+    if queued:
+        terminalreporter.write_sep("=", "ngs job server queueing time")
+        for waited, nodeid in sorted(queued, reverse=True):
+            terminalreporter.write_line("{:8.2f}s {}".format(waited, nodeid))
+    if commands:
+        terminalreporter.write_sep("=", "ngs most expensive commands")
+        terminalreporter.write_line("{:>9} {:>9} {:>9} {:>9}  {}".format(
+            "wall", "user", "sys", "rss(MB)", "command"))
+        for elapsed, utime, stime, maxrss, cmd, nodeid in sorted(
+                commands, key=lambda x: x[0], reverse=True)[:10]:
+            cmd = " ".join(str(cmd).split())
+            terminalreporter.write_line("{:>8.2f}s {:>9} {:>9} {:>9}  {} ({})".format(
+                elapsed, _fmt(utime, "{:.2f}s"), _fmt(stime, "{:.2f}s"),
+                _fmt(maxrss, "{:.0f}"), cmd[:60], nodeid))
+
+
+@pytest.fixture(scope="module")
+def shell_session():
+    """Return a persistent shell session shared by the tests of a
+    module.
+
+    Calling the session runs a command like
+    :py:class:`~pytest_ngsfixtures.shell.shell` without spawning a new
+    shell for every command.
+
+    Examples:
+
+       .. code-block:: python
+
+          def test_output(shell_session, samples):
+              n = shell_session("zcat {} | wc -l".format(samples.join("s1_1.fastq.gz")),
+                                read=True)
+              assert int(n) % 4 == 0
+
+    """
+    from pytest_ngsfixtures.shell import ShellSession
+    session = ShellSession()
+    yield session
+    session.close()
 
 
 class Fixture(LocalPath):
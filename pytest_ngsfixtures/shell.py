@@ -4,11 +4,31 @@ import re
 import os
 import sys
 import shlex
+import time
 import types
+import signal
+import selectors
+import asyncio
+import json
+import mmap
+import shutil
+import functools
+import inspect
+import codecs
+import tempfile
+import threading
+import uuid
+import contextvars
+import collections
 import subprocess as sp
+import concurrent.futures
 import docker
 from docker.models.containers import Container, ExecResult
 import logging
+from pytest_ngsfixtures import jobserver
+from pytest_ngsfixtures.container import get_client, get_pool, bind_mounts, \
+    resource_limits, apply_limits
+from pytest_ngsfixtures.config import CACHE_DIR
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -16,7 +36,34 @@ logger.setLevel(logging.INFO)
 STDOUT = sys.stdout
 
 
-def get_conda_root():
+def _is_conda_root(path):
+    return path is not None and os.path.isdir(os.path.join(path, "conda-meta")) \
+        and os.path.isfile(os.path.join(path, "bin", "conda"))
+
+
+# Environment changes made by activating conda environments
+_activated = {}
+_activated_lock = threading.Lock()
+_ACTIVATE_MARK = "PYTEST_NGSFIXTURES_ACTIVATE"
+
+
+def _conda_root_from_env():
+    """Infer conda root from environment variables set by conda
+    activation, without running conda"""
+    exe = os.environ.get("CONDA_EXE")
+    if exe:
+        root = os.path.dirname(os.path.dirname(exe))
+        if _is_conda_root(root):
+            return root
+    prefix = os.environ.get("CONDA_PREFIX")
+    if prefix:
+        for root in (prefix, os.path.dirname(os.path.dirname(prefix))):
+            if _is_conda_root(root):
+                return root
+    return None
+
+
+def _conda_root_from_info():
     output = sp.check_output(shlex.split("conda info --json"))
     m = re.search("\"root_prefix\":\s+\"(\S+)\",$", output.decode("utf-8"), re.MULTILINE)
     try:
@@ -26,6 +73,803 @@ def get_conda_root():
         raise
 
 
+_conda_root = None
+
+
+def get_conda_root():
+    """Return conda root prefix.
+
+    The root is looked up once per session. CONDA_EXE and CONDA_PREFIX
+    are used if they point to a conda root; otherwise the result of
+    'conda info --json' is cached persistently in CACHE_DIR, keyed on
+    the conda executable path and invalidated by its modification
+    time.
+    """
+    global _conda_root
+    if _conda_root is not None:
+        return _conda_root
+    root = _conda_root_from_env()
+    if root is None:
+        exe = shutil.which("conda")
+        key = "{}:{}".format(exe, os.stat(exe).st_mtime if exe else None)
+        cachefile = CACHE_DIR / "conda_root.json"
+        try:
+            with open(str(cachefile)) as fh:
+                cache = json.load(fh)
+        except (OSError, ValueError):
+            cache = {}
+        root = cache.get(key)
+        if not _is_conda_root(root):
+            root = _conda_root_from_info()
+            cache = {key: root}
+            try:
+                cachefile.parent.mkdir(parents=True, exist_ok=True)
+                tmp = "{}.{}".format(cachefile, os.getpid())
+                with open(tmp, "w") as fh:
+                    json.dump(cache, fh)
+                os.replace(tmp, str(cachefile))
+            except OSError as e:
+                logger.warning("Failed to cache conda root prefix: {}".format(e))
+    _conda_root = root
+    return root
+
+
+@functools.lru_cache(maxsize=None)
+def _conda_env_bin(conda_root, env):
+    """Return bin directory of conda environment env; validated once"""
+    p = os.path.join(conda_root, "envs", env, "bin")
+    if not os.path.isdir(p):
+        logger.warning("conda environment bin directory {} does not exist".format(p))
+    return p
+
+
+CHUNK_SIZE = 2 ** 16
+STDERR_TAIL = 2 ** 16
+
+# Options of shell.map passed on to docker exec for running containers
+_EXEC_RUN_OPTIONS = ("user", "environment", "workdir", "privileged")
+
+
+def _activation_delta(out):
+    """Return the changes conda activation makes to the environment.
+
+    Args:
+      out (bytes): NUL-separated environment before activation, the
+                   activation mark and the environment after activation
+
+    Returns:
+      tuple of changed variables, unset variable names, and PATH
+      entries added and removed
+    """
+    entries = out.decode().split("\0")
+    i = entries.index(_ACTIVATE_MARK)
+    before, after = [dict(x.split("=", 1) for x in e if "=" in x)
+                     for e in (entries[:i], entries[i + 1:])]
+    changed = {k: v for k, v in after.items() if before.get(k) != v and k not in ("_", "PATH")}
+    unset = [k for k in before if k not in after and k != "PATH"]
+    path_before = before.get("PATH", "").split(":")
+    path_after = after.get("PATH", "").split(":")
+    added = [p for p in path_after if p not in path_before]
+    removed = [p for p in path_before if p not in path_after]
+    return changed, unset, (added, removed)
+
+
+class _LineSplitter:
+    """Incremental splitter of chunks into lines, see :py:func:`iter_lines`"""
+    def __init__(self, encoding="utf-8"):
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors="replace") if encoding else None
+        self._sep, self._empty = (b"\n", b"") if self._decoder is None else ("\n", "")
+        self._parts = []
+
+    def feed(self, chunk):
+        """Return the lines completed by chunk"""
+        if isinstance(chunk, bytes):
+            if self._decoder is not None:
+                chunk = self._decoder.decode(chunk)
+        elif self._decoder is None:
+            chunk = chunk.encode()
+        lines = chunk.split(self._sep)
+        if len(lines) == 1:
+            if chunk:
+                self._parts.append(chunk)
+            return []
+        self._parts.append(lines[0])
+        ret = [self._empty.join(self._parts)] + lines[1:-1]
+        self._parts = [lines[-1]] if lines[-1] else []
+        return ret
+
+    def close(self):
+        """Return the trailing partial line, if any, as a list"""
+        if self._decoder is not None:
+            self._parts.append(self._decoder.decode(b"", final=True))
+        tail = self._empty.join(self._parts)
+        self._parts = []
+        return [tail] if tail else []
+
+
+def iter_lines(chunks, encoding="utf-8"):
+    """Split a stream of chunks into lines.
+
+    Chunks are decoded with an incremental decoder so that multi-byte
+    characters and lines spanning chunk boundaries are handled
+    correctly. Line terminators are stripped, and a trailing partial
+    line is yielded at the end of the stream.
+
+    Args:
+      chunks (iterable): bytes or str chunks
+      encoding (str): encoding of byte chunks; if None, yield bytes
+
+    Yields:
+      lines as str, or bytes if encoding is None
+    """
+    splitter = _LineSplitter(encoding)
+    for chunk in chunks:
+        yield from splitter.feed(chunk)
+    yield from splitter.close()
+
+
+Usage = collections.namedtuple("Usage", ["cmd", "elapsed", "utime", "stime", "maxrss_mb"])
+Usage.__doc__ = """Resource usage of a command.
+
+Times are in seconds and peak RSS in megabytes. For commands run in
+a container, utime holds the CPU time of the whole container during
+the command; fields unavailable for a backend are None.
+"""
+
+_usage = []
+_usage_lock = threading.Lock()
+# ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+_MAXRSS_UNIT = 2**20 if sys.platform == "darwin" else 2**10
+
+
+def _record(usage):
+    with _usage_lock:
+        _usage.append(usage)
+
+
+def usage(reset=False):
+    """Return resource usage of commands run since the last reset.
+
+    Args:
+      reset (bool): clear recorded usage
+
+    Returns:
+      list of :py:class:`Usage`
+    """
+    with _usage_lock:
+        ret = list(_usage)
+        if reset:
+            del _usage[:]
+    return ret
+
+
+_EXECUTE_CHILD_ARGS = list(inspect.signature(sp.Popen._execute_child).parameters)[1:]
+_SPAWN_SIGDEF = [getattr(signal, s) for s in ('SIGPIPE', 'SIGXFZ', 'SIGXFSZ')
+                 if hasattr(signal, s)]
+
+
+def _inheritable_fds():
+    """Return the inheritable file descriptors above 2 of this process,
+    or None if they cannot be listed"""
+    for fddir in ("/proc/self/fd", "/dev/fd"):
+        try:
+            fds = [int(fd) for fd in os.listdir(fddir)]
+            break
+        except (OSError, ValueError):
+            continue
+    else:
+        return None
+    ret = []
+    for fd in fds:
+        try:
+            if fd > 2 and os.get_inheritable(fd):
+                ret.append(fd)
+        except OSError:
+            # e.g. the descriptor used to list the directory
+            continue
+    return ret
+
+
+class _Popen(sp.Popen):
+    """Popen that records wall time, CPU time and peak RSS of the
+    child process tree when the child is reaped.
+
+    If timeout is set, the child is started in a new session and the
+    whole process group is sent SIGTERM once the timeout expires,
+    followed by SIGKILL after grace seconds.
+
+    Children are launched with :py:func:`os.posix_spawn` whenever the
+    options allow it, so that large parents do not pay for copying
+    their page tables on fork. Unlike the check in
+    :py:mod:`subprocess`, redirections to the standard streams (e.g.
+    stderr to the parent's stdout) and new sessions are supported, and
+    close_fds is honoured by closing the inheritable descriptors in the
+    child; descriptors created by Python are non-inheritable anyway
+    (PEP 446). Other cases fall back to the regular fork/exec path.
+    """
+    use_spawn = hasattr(os, "posix_spawn")
+
+    def __init__(self, *args, timeout=None, grace=5.0, **kwargs):
+        self._started = time.time()
+        self.timeout = timeout
+        self.timed_out = False
+        self._timer = None
+        if timeout is not None:
+            kwargs["start_new_session"] = True
+        self._group = bool(kwargs.get("start_new_session"))
+        super().__init__(*args, **kwargs)
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._expire, args=(grace,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _expire(self, grace):
+        if self.poll() is not None:
+            return
+        self.timed_out = True
+        logger.error("Command '{}' timed out after {} seconds; terminating".format(self.args, self.timeout))
+        self.kill_group(grace)
+
+    def kill_group(self, grace=5.0):
+        """Send SIGTERM to the process group, and SIGKILL after grace
+        seconds. Only the child is killed if it was not started in a
+        new session"""
+        if not self._group:
+            self.kill()
+            return
+        try:
+            os.killpg(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        try:
+            self.wait(timeout=grace)
+        except sp.TimeoutExpired:
+            pass
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def check(self):
+        """Raise if the process timed out or failed"""
+        if self.timed_out:
+            raise sp.TimeoutExpired(self.args, self.timeout)
+        if self.returncode:
+            raise sp.CalledProcessError(self.returncode, self.args)
+
+    def _spawnable(self, opts):
+        if not self.use_spawn or opts.get("pass_fds"):
+            return False
+        if any(opts.get(k) is not None for k in ("preexec_fn", "cwd", "gid", "gids", "uid")):
+            return False
+        return opts.get("umask", -1) < 0 and opts.get("process_group", -1) == -1
+
+    def _execute_child(self, *args):
+        opts = dict(zip(_EXECUTE_CHILD_ARGS, args))
+        if not self._spawnable(opts):
+            return super()._execute_child(*args)
+        argv = opts["args"]
+        if isinstance(argv, (str, bytes, os.PathLike)):
+            argv = [argv]
+        else:
+            argv = list(argv)
+        if opts["shell"]:
+            argv = ["/bin/sh", "-c"] + argv
+            if opts["executable"]:
+                argv[0] = opts["executable"]
+        executable = opts["executable"] or argv[0]
+        env = opts["env"] if opts["env"] is not None else os.environ
+        if not os.path.dirname(os.fsdecode(executable)):
+            # posix_spawn does not search PATH
+            executable = shutil.which(executable, path=env.get("PATH", os.defpath))
+            if executable is None:
+                return super()._execute_child(*args)
+        inheritable = _inheritable_fds() if opts.get("close_fds") else []
+        if inheritable is None:
+            return super()._execute_child(*args)
+        kwargs = {}
+        if opts.get("restore_signals"):
+            kwargs["setsigdef"] = _SPAWN_SIGDEF
+        if opts.get("start_new_session"):
+            kwargs["setsid"] = True
+        # Targets that are themselves standard streams are duplicated
+        # to private descriptors first so that the dup2 actions below
+        # cannot clobber each other
+        dups = []
+        actions = [(os.POSIX_SPAWN_CLOSE, fd)
+                   for fd in (opts["p2cwrite"], opts["c2pread"], opts["errread"])
+                   if fd != -1]
+        try:
+            for fd, target in ((opts["p2cread"], 0), (opts["c2pwrite"], 1),
+                               (opts["errwrite"], 2)):
+                if fd == -1 or fd == target:
+                    continue
+                if fd <= 2:
+                    fd = os.dup(fd)
+                    dups.append(fd)
+                actions.append((os.POSIX_SPAWN_DUP2, fd, target))
+            # After the dup2 actions, which may read from these
+            actions += [(os.POSIX_SPAWN_CLOSE, fd) for fd in inheritable]
+            try:
+                self.pid = os.posix_spawn(executable, argv, env,
+                                          file_actions=actions, **kwargs)
+            except (NotImplementedError, TypeError):
+                # e.g. setsid not supported by the C library
+                return super()._execute_child(*args)
+        finally:
+            for fd in dups:
+                os.close(fd)
+        self._child_created = True
+        self._close_pipe_fds(opts["p2cread"], opts["p2cwrite"],
+                             opts["c2pread"], opts["c2pwrite"],
+                             opts["errread"], opts["errwrite"])
+
+    def _wait4(self, pid, wait_flags):
+        (pid, sts, ru) = os.wait4(pid, wait_flags)
+        if pid == self.pid:
+            _record(Usage(self.args, time.time() - self._started,
+                          ru.ru_utime, ru.ru_stime, ru.ru_maxrss / _MAXRSS_UNIT))
+        return (pid, sts)
+
+    def _try_wait(self, wait_flags):
+        try:
+            return self._wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return (self.pid, 0)
+
+    def _internal_poll(self, *args, **kwargs):
+        # poll() reaps with os.waitpid rather than _try_wait
+        kwargs["_waitpid"] = self._wait4
+        return super()._internal_poll(*args, **kwargs)
+
+    def _handle_exitstatus(self, *args, **kwargs):
+        # Called whenever the child has been reaped, however it was waited for
+        if self._timer is not None:
+            self._timer.cancel()
+        return super()._handle_exitstatus(*args, **kwargs)
+
+
+# Without one_shot, docker waits for a second sample before
+# returning stats, which would add seconds to every command
+_STATS_ONE_SHOT = "one_shot" in inspect.signature(docker.APIClient.stats).parameters
+
+
+def _container_cpu(container):
+    """Return total container CPU time in seconds, or None if stats
+    can not be read in a single sample"""
+    if not _STATS_ONE_SHOT:
+        return None
+    try:
+        stats = container.stats(stream=False, one_shot=True)
+        return stats["cpu_stats"]["cpu_usage"]["total_usage"] / 1e9
+    except Exception:
+        return None
+
+
+Result = collections.namedtuple("Result", ["cmd", "returncode", "elapsed", "stdout", "stderr"])
+Result.__doc__ = """Outcome of a command run with :py:meth:`shell.map`"""
+
+
+class OutputLimitExceeded(sp.SubprocessError):
+    """Raised when captured output exceeds the requested size cap"""
+    def __init__(self, cmd, max_bytes, stderr=None):
+        self.cmd = cmd
+        self.max_bytes = max_bytes
+        self.stderr = stderr
+
+    def __str__(self):
+        return "Command '{}' output exceeded {} bytes".format(self.cmd, self.max_bytes)
+
+
+class Capture:
+    """Handle for command output captured to files.
+
+    Output is written by the child process directly to files, or
+    through a size-limited pipe if max_bytes is set, and only read when
+    one of the accessors is called.
+
+    Args:
+      stdout (str): stdout file name
+      stderr (str): stderr file name
+      cmd (str): command string
+      returncode (int): process return code
+    """
+    def __init__(self, stdout, stderr, cmd=None, returncode=None):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.cmd = cmd
+        self.returncode = returncode
+
+    def __repr__(self):
+        return "Capture(stdout='{}', stderr='{}', returncode={})".format(
+            self.stdout, self.stderr, self.returncode)
+
+    def _path(self, stream):
+        assert stream in ("stdout", "stderr"), "stream must be one of stdout, stderr"
+        return getattr(self, stream)
+
+    def size(self, stream="stdout"):
+        """Return size of captured stream in bytes"""
+        return os.path.getsize(self._path(stream))
+
+    def text(self, stream="stdout", encoding="utf-8"):
+        """Return captured stream as a string"""
+        with open(self._path(stream), encoding=encoding, errors="replace") as fh:
+            return fh.read()
+
+    def lines(self, stream="stdout", encoding="utf-8"):
+        """Iterate over lines of captured stream"""
+        with open(self._path(stream), "rb") as fh:
+            yield from iter_lines(iter(lambda: fh.read(CHUNK_SIZE), b""), encoding)
+
+    def mmap(self, stream="stdout"):
+        """Return read-only memory map of captured stream"""
+        with open(self._path(stream), "rb") as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                return b""
+            return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def tail(self, nbytes=4096, stream="stderr", encoding="utf-8"):
+        """Return the last nbytes of captured stream"""
+        with open(self._path(stream), "rb") as fh:
+            fh.seek(max(0, os.fstat(fh.fileno()).st_size - nbytes))
+            return fh.read().decode(encoding, errors="replace")
+
+
+class _AsyncLines:
+    """Async iterator over decoded lines of an asyncio stream.
+
+    The stream is read in chunks and split like :py:func:`iter_lines`,
+    so that lines longer than the stream buffer limit are supported.
+    """
+    def __init__(self, stream, encoding="utf-8"):
+        self._stream = stream
+        self._splitter = _LineSplitter(encoding)
+        self._lines = collections.deque()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._lines:
+            if self._stream is None:
+                raise StopAsyncIteration
+            chunk = await self._stream.read(CHUNK_SIZE)
+            if chunk:
+                self._lines.extend(self._splitter.feed(chunk))
+            else:
+                self._lines.extend(self._splitter.close())
+                self._stream = None
+        return self._lines.popleft()
+
+
+class AsyncProcess:
+    """Handle for a command started with :py:meth:`shell.run_async`.
+
+    Iterating asynchronously over the handle yields stdout lines;
+    stderr lines are available via :py:attr:`stderr` if stderr was
+    piped. Note that piped streams must be drained concurrently, or
+    the child will block once the pipe buffer is full.
+
+    Args:
+      proc (asyncio.subprocess.Process): process
+      cmd (str): command string
+      token (str): job server token to release on completion
+    """
+    def __init__(self, proc, cmd, token=None):
+        self.proc = proc
+        self.cmd = cmd
+        self._token = token
+        self._stdout = _AsyncLines(proc.stdout)
+        self._stderr = _AsyncLines(proc.stderr)
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    @property
+    def returncode(self):
+        return self.proc.returncode
+
+    @property
+    def stdout(self):
+        """Async iterator over stdout lines"""
+        return self._stdout
+
+    @property
+    def stderr(self):
+        """Async iterator over stderr lines"""
+        return self._stderr
+
+    def __aiter__(self):
+        return self.stdout
+
+    def _done(self):
+        jobserver.release(self._token)
+        self._token = None
+
+    async def cancel(self, grace=5.0):
+        """Terminate the process group, escalating to kill after grace
+        seconds"""
+        if self.proc.returncode is None:
+            try:
+                os.killpg(self.proc.pid, signal.SIGTERM)
+                await asyncio.wait_for(self.proc.wait(), grace)
+            except ProcessLookupError:
+                pass
+            except asyncio.TimeoutError:
+                pass
+            try:
+                # Reap jobs of the command that outlived the shell
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await self.proc.wait()
+        self._done()
+
+    async def _finish(self, coro, check):
+        try:
+            ret = await coro
+        except asyncio.CancelledError:
+            await asyncio.shield(self.cancel())
+            raise
+        self._done()
+        if check and self.proc.returncode:
+            raise sp.CalledProcessError(self.proc.returncode, self.cmd)
+        return ret
+
+    async def wait(self, check=True):
+        """Wait for process to finish.
+
+        Cancelling the awaiting task terminates the process.
+
+        Raises:
+          CalledProcessError: if check is set and the process failed
+        """
+        return await self._finish(self.proc.wait(), check)
+
+    async def communicate(self, check=True):
+        """Wait for process to finish and return decoded (stdout, stderr)"""
+        out, err = await self._finish(self.proc.communicate(), check)
+        return (out.decode() if out is not None else None,
+                err.decode() if err is not None else None)
+
+
+class ContainerStream:
+    """Demultiplexed line stream of a command run in a container.
+
+    The command is started with docker exec and its output is read
+    frame by frame as the stream is iterated. Nothing is read ahead of
+    the consumer, so a slow consumer blocks the command once the
+    socket buffers are full instead of accumulating output in memory.
+    Iterating yields stdout lines; stderr is written to stderr if it
+    is a file object, and its tail is kept for error messages.
+
+    Args:
+      container (Container): running container
+      cmd (str): command to execute
+      encoding (str): output encoding; if None, yield bytes
+      stderr (file): file object to write stderr to
+      timeout (float): timeout used to wrap cmd, if any; an exit code
+                       of 124 is then reported as a timeout
+      on_close (callable): called once the stream has been consumed
+                           or closed
+      kwargs (dict): additional arguments to
+                     :py:meth:`docker.api.exec_api.ExecApiMixin.exec_create`,
+                     e.g. workdir, user, environment
+
+    Examples:
+
+      .. code-block:: python
+
+         stream = ContainerStream(container, "samtools view aln.bam")
+         for line in stream:
+             ...
+         assert stream.exit_code == 0
+    """
+    def __init__(self, container, cmd, encoding="utf-8", stderr=None,
+                 timeout=None, on_close=None, **kwargs):
+        self.cmd = cmd
+        self.encoding = encoding
+        self.timeout = timeout
+        self._stderr = stderr if hasattr(stderr, "write") else None
+        self._tail = collections.deque()
+        self._tail_size = 0
+        self._on_close = on_close
+        self._api = container.client.api
+        self.exec_id = self._api.exec_create(container.id, cmd, stdout=True,
+                                             stderr=True, **kwargs)["Id"]
+        self._frames = self._api.exec_start(self.exec_id, stream=True, demux=True)
+
+    def _keep(self, data):
+        self._tail.append(data)
+        self._tail_size += len(data)
+        while self._tail_size - len(self._tail[0]) >= STDERR_TAIL:
+            self._tail_size -= len(self._tail.popleft())
+
+    @property
+    def stderr(self):
+        """Tail of the stderr output"""
+        return b"".join(self._tail)[-STDERR_TAIL:]
+
+    @property
+    def exit_code(self):
+        """Exit code of the command, or None if it is still running"""
+        info = self._api.exec_inspect(self.exec_id)
+        return None if info.get("Running") else info.get("ExitCode")
+
+    def wait(self, timeout=5.0, poll=0.05):
+        """Wait for docker to report the exit code of the command.
+
+        The exec may still be reported as running for a short while
+        after its output stream has ended.
+
+        Returns:
+          exit code, or None if the command still runs after timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        exit_code = self.exit_code
+        while exit_code is None and time.monotonic() < deadline:
+            time.sleep(poll)
+            exit_code = self.exit_code
+        return exit_code
+
+    def _stdout(self):
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        for out, err in self._frames:
+            if err:
+                self._keep(err)
+                if self._stderr is not None:
+                    self._stderr.write(decoder.decode(err))
+            if out:
+                yield out
+
+    def __iter__(self):
+        try:
+            yield from iter_lines(self._stdout(), self.encoding)
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop reading output; the command may continue to run"""
+        self._frames.close()
+        if self._on_close is not None:
+            on_close, self._on_close = self._on_close, None
+            on_close()
+
+    def check(self):
+        """Raise if the command timed out or failed"""
+        exit_code = self.wait()
+        if exit_code is None:
+            raise sp.SubprocessError("Command '{}' did not report an exit code".format(self.cmd))
+        if self.timeout is not None and exit_code == 124:
+            raise sp.TimeoutExpired(self.cmd, self.timeout, stderr=self.stderr)
+        if exit_code:
+            raise sp.CalledProcessError(exit_code, self.cmd, stderr=self.stderr)
+
+
+class ShellSession:
+    """Persistent shell coprocess for running many short commands.
+
+    Commands are written to the standard input of a long-lived shell
+    and run in a subshell, so that exit, cd and set options in one
+    command do not affect the next. Output is framed by a random
+    sentinel which also carries the exit status. If the shell dies it
+    is respawned on the next call; on timeout the shell and all its
+    children are killed.
+
+    Examples:
+
+      .. code-block:: python
+
+         with ShellSession() as session:
+             for f in files:
+                 session("zcat {} | head -4".format(f), read=True)
+
+    Args:
+      executable (str): shell executable; defaults to the shell class executable
+    """
+    def __init__(self, executable=None):
+        self.executable = executable
+        self._proc = None
+        self._lock = threading.Lock()
+        self._sentinel = "__NGS_{}__".format(uuid.uuid4().hex).encode()
+
+    def __call__(self, cmd, **kwargs):
+        """Run cmd in session; see :py:class:`shell` for arguments"""
+        return shell(cmd, persistent=self, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def pid(self):
+        return None if self._proc is None else self._proc.pid
+
+    def _spawn(self):
+        executable = self.executable or shell._process_args.get("executable", "/bin/bash")
+        self._proc = sp.Popen([executable], stdin=sp.PIPE, stdout=sp.PIPE,
+                              stderr=sp.PIPE, bufsize=0, start_new_session=True)
+        logger.debug("Started shell session {} ({})".format(self._proc.pid, executable))
+
+    def close(self):
+        """Terminate the shell and its children"""
+        if self._proc is None:
+            return
+        try:
+            os.killpg(self._proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self._proc.wait()
+        for f in (self._proc.stdin, self._proc.stdout, self._proc.stderr):
+            f.close()
+        self._proc = None
+
+    def run(self, cmd, env=None, timeout=None):
+        """Run command string in session.
+
+        Args:
+          cmd (str): command string
+          env (dict): environment variables to export for this command
+          timeout (float): kill the session after timeout seconds
+
+        Returns:
+          tuple of return code, stdout and stderr
+        """
+        exports = "".join("export {}={}; ".format(k, shlex.quote(v)) for k, v in (env or {}).items()
+                          if os.environ.get(k) != v and re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", k))
+        script = "( {}{}\n) < /dev/null; __ngs_rc=$?; printf '\\n%s %d\\n' {} $__ngs_rc; printf '\\n%s\\n' {} >&2\n".format(
+            exports, cmd, self._sentinel.decode(), self._sentinel.decode())
+        with self._lock:
+            if self._proc is None or self._proc.poll() is not None:
+                if self._proc is not None:
+                    logger.warning("Shell session died; respawning")
+                    self.close()
+                self._spawn()
+            start = time.time()
+            try:
+                self._proc.stdin.write(script.encode())
+                out, err = self._read(timeout)
+            except (BrokenPipeError, EOFError):
+                self.close()
+                raise sp.SubprocessError("shell session died running '{}'".format(cmd))
+            except sp.TimeoutExpired:
+                self.close()
+                raise sp.TimeoutExpired(cmd, timeout)
+        out, _, rc = out.rpartition(b"\n" + self._sentinel + b" ")
+        err = err[:err.rfind(b"\n" + self._sentinel)]
+        returncode = int(rc)
+        _record(Usage(cmd, time.time() - start, None, None, None))
+        return returncode, out, err
+
+    def _read(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        bufs = {self._proc.stdout: bytearray(), self._proc.stderr: bytearray()}
+        done = {self._proc.stdout: False, self._proc.stderr: False}
+        ends = {self._proc.stdout: re.compile(b"\n" + self._sentinel + b" -?\\d+\n$"),
+                self._proc.stderr: re.compile(b"\n" + self._sentinel + b"\n$")}
+        with selectors.DefaultSelector() as sel:
+            for f in bufs:
+                sel.register(f, selectors.EVENT_READ)
+            while not all(done.values()):
+                wait = None if deadline is None else deadline - time.time()
+                if wait is not None and wait <= 0:
+                    raise sp.TimeoutExpired(None, timeout)
+                for key, _ in sel.select(wait):
+                    data = os.read(key.fd, CHUNK_SIZE)
+                    if not data:
+                        raise EOFError
+                    buf = bufs[key.fileobj]
+                    buf += data
+                    if ends[key.fileobj].search(buf[-len(self._sentinel) - 32:]):
+                        done[key.fileobj] = True
+                        sel.unregister(key.fileobj)
+        return bytes(bufs[self._proc.stdout]).rstrip(b"\n"), bytes(bufs[self._proc.stderr])
+
+
 class shell:
     """Class wrapper for shell commands.
 
@@ -35,7 +879,12 @@ class shell:
     Based on snakemake shell implementation by Johannes Köster.
 
     Args:
-      cmd (str): command string
+      cmd (str, list): command string, or argument list to execute
+                       directly without a shell. Argument lists
+                       skip the process prefix; PATH and conda
+                       settings are applied via the process
+                       environment. In containers, argument lists
+                       are quoted and run as a command string
       container (Container): docker/singularity container instance
       conda_env (str): conda environment to activate
       conda_env_list (list): additional conda environment paths to add
@@ -50,6 +899,54 @@ class shell:
       read (bool): read and return output
       async_ (bool): run asynchronously
       path_list (list): prefix command with additional paths
+      capture (str, LocalPath): directory to which stdout and stderr
+                                are written; returns a :py:class:`Capture`
+                                handle. Local runs only
+      max_bytes (int): write at most max_bytes of stdout and stderr
+                       to the capture files, and kill the command
+                       with :py:class:`OutputLimitExceeded` if either
+                       exceeds it. Requires capture
+      timeout (float): terminate the command after timeout seconds
+                       and raise :py:class:`subprocess.TimeoutExpired`.
+                       Local commands run in a new session whose
+                       process group is sent SIGTERM, then SIGKILL;
+                       containerized commands are wrapped in the
+                       container's timeout utility
+      grace (float): seconds between SIGTERM and SIGKILL on timeout
+      pool (bool): run image commands via exec in a warm container
+                   from the process-wide
+                   :py:class:`~pytest_ngsfixtures.container.ContainerPool`
+                   instead of creating a new container per command.
+                   The container arguments (e.g. user, volumes) select
+                   the pooled container; working_dir and environment
+                   apply per command. Non-zero exit codes raise
+                   :py:class:`docker.errors.ContainerError`
+      mounts (list): files and directories to bind mount at the same
+                     location in image runs, in addition to any
+                     volumes; see
+                     :py:func:`~pytest_ngsfixtures.container.bind_mounts`.
+                     The package data directory is mounted read-only
+      limits (bool): constrain the CPUs and memory of containerized
+                     commands to the resources reserved from the job
+                     server (threads, or the ngs_resources marker of
+                     the calling test), or to the number of ngs
+                     threads. Reserved cores are pinned via cpusets.
+                     By default, containers created for the command
+                     get the limits at creation and pooled containers
+                     are updated when leased; a running container
+                     passed with container is only updated before
+                     exec if limits is True, since the update persists
+                     for every later command run in it
+      persistent (bool, ShellSession): run command in a persistent
+                                       shell session instead of
+                                       spawning a new shell; if True,
+                                       use a process-wide session.
+                                       Output is collected before
+                                       returning
+      encoding (str): encoding of iterated output; if None, iterate
+                      over bytes
+      threads (int): number of cores to reserve from the job server
+                     while the command runs
       stdout (_io.TextIOWrapper, int): stdout file object
       stderr (int): stderr special value
       stream (bool): stream containerized run; alias to iterable
@@ -61,10 +958,11 @@ class shell:
                             pipefail' may fail
 
     Returns:
-      stdout if read is set, an iterable if iterable is set, a process (either :py:mod:`subprocess.Popen` or :py:mod:`docker.models.containers.Container`) if async is set, None otherwise
+      stdout if read is set, a :py:class:`Capture` if capture is set, an iterable if iterable is set, a process (either :py:mod:`subprocess.Popen` or :py:mod:`docker.models.containers.Container`) if async is set, None otherwise
     """
     _process_args = {}
     _process_prefix = ""
+    _threads = 1
 
     @classmethod
     def executable(cls, cmd):
@@ -76,34 +974,36 @@ class shell:
     def prefix(cls, prefix):
         cls._process_prefix = prefix
 
-    def __new__(cls, cmd,
-                container=None,
-                conda_env=None,
-                conda_env_list=[],
-                conda_root=None,
-                image=None,
-                iterable=False,
-                read=False,
-                async_=False,
-                path_list=[],
-                **kwargs):
+    @classmethod
+    def spawn(cls, enabled=True):
+        """Launch local commands with :py:func:`os.posix_spawn` where possible.
 
-        stdout = sp.PIPE if iterable or async_ or read else kwargs.pop("stdout", STDOUT)
-        stderr = kwargs.pop("stderr", STDOUT)
+        Inheritable file descriptors are still closed in the child
+        unless close_fds is disabled. Disable spawning to get the
+        regular fork/exec behaviour of :py:mod:`subprocess`.
+        """
+        _Popen.use_spawn = bool(enabled) and hasattr(os, "posix_spawn")
 
-        close_fds = sys.platform != 'win32'
-        plist = path_list
-        if kwargs.get("stream", False):
-            iterable = kwargs.pop("stream")
-        if kwargs.get("detach", False):
-            async_ = kwargs.pop("detach")
+    @classmethod
+    def _close_fds(cls):
+        return sys.platform != 'win32'
+
+    @classmethod
+    def threads(cls, n):
+        """Set default number of concurrent commands in :py:meth:`map`"""
+        cls._threads = int(n)
 
+    @classmethod
+    def _command(cls, cmd, conda_env=None, conda_env_list=[],
+                 conda_root=None, path_list=[], process_prefix=None):
+        """Build command string with process prefix, PATH and conda
+        activation"""
+        plist = list(path_list)
         if conda_env_list:
             if not conda_root:
                 conda_root = get_conda_root()
             for env in conda_env_list:
-                p = os.path.join(conda_root, "envs", env, "bin")
-                plist.append(p)
+                plist.append(_conda_env_bin(conda_root, env))
         if plist:
             plist.append("$PATH")
             path = "PATH=\"{}\";".format(":".join(plist))
@@ -117,53 +1017,634 @@ class shell:
             env_prefix = "source activate {};".format(conda_env)
             logger.info("Activating conda environment {}.".format(conda_env))
 
-        cmd = "{} {} {} {}".format(
-            kwargs.pop("process_prefix", cls._process_prefix),
+        return "{} {} {} {}".format(
+            cls._process_prefix if process_prefix is None else process_prefix,
             path,
             env_prefix,
             cmd.rstrip())
 
+    @classmethod
+    def _environ(cls, conda_env, conda_root=None):
+        """Return process environment of activated conda environment.
+
+        The changes activation makes to the environment (entries
+        added to or removed from PATH, CONDA_* and variables set by
+        activate.d scripts) are captured once per conda environment
+        and reused until the environment's conda-meta directory
+        changes. They are applied to the current process environment
+        on every call, so that later changes to os.environ, including
+        PATH, are honoured. Failed captures are cached as well.
+
+        Returns:
+          environment dictionary, or None if activation could not be
+          captured, in which case the command should activate the
+          environment itself
+        """
+        if not conda_env:
+            return None
+        if os.path.isabs(conda_env):
+            prefix = conda_env
+        else:
+            root = conda_root or get_conda_root()
+            prefix = root if conda_env in ("base", "root") else os.path.join(root, "envs", conda_env)
+        meta = os.path.join(prefix, "conda-meta")
+        try:
+            stamp = [os.stat(meta).st_mtime_ns]
+            if os.path.exists(os.path.join(meta, "history")):
+                stamp.append(os.stat(os.path.join(meta, "history")).st_mtime_ns)
+        except OSError:
+            return None
+        with _activated_lock:
+            cached = _activated.get(prefix)
+        if cached is None or cached[0] != stamp:
+            logger.info("Activating conda environment {}.".format(conda_env))
+            try:
+                out = sp.check_output([cls._process_args.get("executable", "/bin/bash"), "-c",
+                                       "env -0; printf '{}\\0'; source activate {} > /dev/null && env -0".format(
+                                           _ACTIVATE_MARK, conda_env)])
+            except (OSError, sp.CalledProcessError) as e:
+                logger.warning("Failed to capture activation of conda environment {}: {}".format(conda_env, e))
+                out = None
+            cached = (stamp, None if out is None else _activation_delta(out))
+            with _activated_lock:
+                _activated[prefix] = cached
+        if cached[1] is None:
+            return None
+        changed, unset, (added, removed) = cached[1]
+        environ = dict(os.environ)
+        environ.update(changed)
+        for k in unset:
+            environ.pop(k, None)
+        path = [p for p in os.environ.get("PATH", os.defpath).split(":") if p not in removed]
+        environ["PATH"] = ":".join(added + path)
+        return environ
+
+    _default_session = None
+
+    @classmethod
+    def _session(cls):
+        """Return the process-wide persistent shell session"""
+        if cls._default_session is None:
+            cls._default_session = ShellSession()
+        return cls._default_session
+
+    @staticmethod
+    def _argv_environ(env, conda_env_list=[], conda_root=None, path_list=[]):
+        """Return environment for direct exec with path_list and conda
+        environment bin directories prepended to PATH"""
+        env = dict(os.environ if env is None else env)
+        plist = list(path_list)
+        if conda_env_list:
+            conda_root = conda_root or get_conda_root()
+            plist += [_conda_env_bin(conda_root, x) for x in conda_env_list]
+        if plist:
+            env["PATH"] = ":".join(plist + [env.get("PATH", os.defpath)])
+        return env
+
+    @classmethod
+    def _wrap(cls, cmd):
+        """Wrap command in executable for containerized runs"""
+        if cls._process_args.get("executable"):
+            cmd = "{} -c '{}'".format(cls._process_args["executable"], cmd)
+        return cmd
+
+    def __new__(cls, cmd,
+                container=None,
+                conda_env=None,
+                conda_env_list=[],
+                conda_root=None,
+                image=None,
+                iterable=False,
+                read=False,
+                async_=False,
+                path_list=[],
+                threads=None,
+                encoding="utf-8",
+                capture=None,
+                max_bytes=None,
+                timeout=None,
+                grace=5.0,
+                persistent=False,
+                pool=False,
+                mounts=None,
+                limits=None,
+                **kwargs):
+
+        if kwargs.get("stream", False):
+            iterable = kwargs.pop("stream")
+        if kwargs.get("detach", False):
+            async_ = kwargs.pop("detach")
+        stdout = sp.PIPE if iterable or async_ or read else kwargs.pop("stdout", STDOUT)
+        stderr = kwargs.pop("stderr", STDOUT)
+
+        if max_bytes is not None and capture is None:
+            raise ValueError("max_bytes requires capture")
+        env = None if container or image else cls._environ(conda_env, conda_root)
+        argv = isinstance(cmd, (list, tuple))
+        if persistent:
+            assert not (container or image or async_ or capture is not None), \
+                "persistent sessions only support blocking local runs"
+            if argv:
+                cmd = " ".join(shlex.quote(str(x)) for x in cmd)
+            cmd = cls._command(cmd, conda_env=None if env else conda_env,
+                               conda_env_list=conda_env_list,
+                               conda_root=conda_root, path_list=path_list,
+                               process_prefix=kwargs.pop("process_prefix", None))
+            if not isinstance(persistent, ShellSession):
+                persistent = cls._session()
+            token = jobserver.acquire(cores=threads) if threads else None
+            try:
+                returncode, out, err = persistent.run(cmd, env=env, timeout=timeout)
+            finally:
+                jobserver.release(token)
+            if returncode:
+                raise sp.CalledProcessError(returncode, cmd, output=out, stderr=err)
+            if iterable:
+                return iter_lines([out], encoding)
+            if read:
+                return out.decode()
+            for data, f in ((out, stdout), (err, stderr)):
+                if data and hasattr(f, "write"):
+                    f.write(data.decode())
+            return None
+        if argv and not (container or image) and (env or not conda_env):
+            # Direct exec; fds created by Python are non-inheritable
+            # (PEP 446) so there is no need to close them in the child
+            env = cls._argv_environ(env, conda_env_list, conda_root, path_list)
+            popen_args = {'shell': False, 'close_fds': False}
+            kwargs.pop("process_prefix", None)
+        else:
+            if argv:
+                cmd = " ".join(shlex.quote(str(x)) for x in cmd)
+            cmd = cls._command(cmd, conda_env=None if env else conda_env,
+                               conda_env_list=conda_env_list,
+                               conda_root=conda_root, path_list=path_list,
+                               process_prefix=kwargs.pop("process_prefix", None))
+            popen_args = dict(shell=True, close_fds=cls._close_fds(), **cls._process_args)
+
         if container or image:
-            if cls._process_args["executable"]:
-                cmd = "{} -c '{}'".format(cls._process_args["executable"], cmd)
-        if container:
+            assert capture is None, "capture is only supported for local runs"
+            if mounts is not None:
+                if container:
+                    logger.warning("mounts are ignored for running containers")
+                else:
+                    volumes = bind_mounts(mounts)
+                    extra = kwargs.get("volumes") or {}
+                    if isinstance(extra, dict):
+                        volumes.update(extra)
+                    else:
+                        volumes = ["{}:{}:{}".format(k, v['bind'], v['mode'])
+                                   for k, v in volumes.items()] + list(extra)
+                    kwargs["volumes"] = volumes
+            cmd = cls._wrap(cmd)
+            if timeout is not None:
+                cmd = "timeout -s TERM -k {} {} {}".format(int(grace) or 1, timeout, cmd)
+        # Detached processes outlive this call so there is no point
+        # at which their tokens could be returned
+        token = jobserver.acquire(cores=threads) if threads and not async_ else None
+        if capture is not None:
             try:
-                proc = container.exec_run(cmd, stream=iterable,
-                                          detach=async_,
-                                          **kwargs)
+                return cls._capture(cmd, capture, max_bytes=max_bytes,
+                                    timeout=timeout, grace=grace, env=env,
+                                    **popen_args)
+            finally:
+                jobserver.release(token)
+        blocking = not (iterable or async_)
+        try:
+            start, cpu = time.time(), None
+            if limits is None:
+                limits = not container
+            if (container or image) and limits:
+                constraints = cls._limits(update=bool(container or pool))
+                if container:
+                    apply_limits(container, **constraints)
+                elif pool:
+                    kwargs["limits"] = constraints
+                else:
+                    for k, v in constraints.items():
+                        kwargs.setdefault(k, v)
+            if container:
+                if blocking:
+                    cpu = _container_cpu(container)
+                if iterable and not async_:
+                    proc = ContainerStream(container, cmd, encoding=encoding,
+                                           stderr=stderr, timeout=timeout, **kwargs)
+                else:
+                    proc = container.exec_run(cmd, detach=async_, **kwargs)
                 if async_:
                     proc = proc.output
-            except:
-                raise
-        elif image:
-            try:
-                client = docker.from_env()
-                proc = client.containers.run(image, command=cmd,
-                                             detach=async_,
-                                             **kwargs)
-            except:
-                raise
-        else:
-            proc = sp.Popen(cmd,
-                            bufsize=-1,
-                            shell=True,
-                            stdout=stdout,
-                            stderr=stderr,
-                            close_fds=close_fds, **cls._process_args)
+                if blocking:
+                    end = _container_cpu(container)
+                    cpu = end - cpu if None not in (cpu, end) else None
+                    _record(Usage(cmd, time.time() - start, cpu, None, None))
+                    if timeout is not None and proc.exit_code == 124:
+                        raise sp.TimeoutExpired(cmd, timeout)
+            elif image and pool:
+                assert not async_, "pooled containers do not support detached runs"
+                proc = cls._exec_pooled(cmd, image, iterable, timeout,
+                                        encoding=encoding, stderr=stderr, **kwargs)
+                if blocking:
+                    _record(Usage(cmd, time.time() - start, None, None, None))
+            elif image:
+                client = get_client()
+                try:
+                    proc = client.containers.run(image, command=cmd,
+                                                 detach=async_,
+                                                 **kwargs)
+                except docker.errors.ContainerError as e:
+                    if timeout is not None and e.exit_status == 124:
+                        raise sp.TimeoutExpired(cmd, timeout)
+                    raise
+                if blocking:
+                    _record(Usage(cmd, time.time() - start, None, None, None))
+            else:
+                proc = _Popen(cmd,
+                              bufsize=-1,
+                              stdout=stdout,
+                              stderr=stderr,
+                              timeout=timeout, grace=grace, env=env,
+                              **popen_args)
+        except BaseException:
+            jobserver.release(token)
+            raise
 
         if iterable:
-            return cls.iter_stdout(proc, cmd)
-        if read:
-            proc = cls.read_stdout(proc)
-            return cls.stdout(proc, cmd, ret=proc)
-        elif async_:
+            return cls._release_after(cls.iter_stdout(proc, cmd, encoding=encoding), token)
+        try:
+            if read:
+                out = cls.read_stdout(proc)
+                if isinstance(proc, sp.Popen):
+                    cls.stdout(proc, cmd)
+                    out = out.decode()
+                return cls.stdout(out, cmd, ret=out)
+            elif async_:
+                return proc
+
+            return cls.stdout(proc, cmd)
+        finally:
+            jobserver.release(token)
+
+    @staticmethod
+    def _exec_kwargs(kwargs):
+        """Split run arguments into container and exec arguments"""
+        kwargs = dict(kwargs)
+        exec_kwargs = {'workdir': kwargs.pop("working_dir", None),
+                       'environment': kwargs.pop("environment", None)}
+        for k in ("remove", "detach", "stream", "command", "auto_remove"):
+            kwargs.pop(k, None)
+        return kwargs, exec_kwargs
+
+    @classmethod
+    def _limits(cls, update=False):
+        """Return container constraints for the resources reserved by
+        the calling context"""
+        allocation = jobserver.allocation()
+        resources = allocation['resources']
+        return resource_limits(cores=resources.get('cores') or cls._threads,
+                               mem_mb=resources.get('mem_mb'),
+                               cpus=allocation['cpus'], update=update)
+
+    @classmethod
+    def _exec_pooled(cls, cmd, image, iterable=False, timeout=None,
+                     encoding="utf-8", stderr=None, limits=None, **kwargs):
+        run_kwargs, exec_kwargs = cls._exec_kwargs(kwargs)
+        pool = get_pool()
+        container = pool.acquire(image, **run_kwargs)
+        apply_limits(container, **(limits or {}))
+        try:
+            if iterable:
+                return ContainerStream(
+                    container, cmd, encoding=encoding, stderr=stderr,
+                    timeout=timeout,
+                    on_close=lambda: pool.release(container, image, **run_kwargs),
+                    **exec_kwargs)
+            res = container.exec_run(cmd, **exec_kwargs)
+        except BaseException:
+            pool.release(container, image, **run_kwargs)
+            raise
+        pool.release(container, image, **run_kwargs)
+        if timeout is not None and res.exit_code == 124:
+            raise sp.TimeoutExpired(cmd, timeout)
+        if res.exit_code:
+            raise docker.errors.ContainerError(container, res.exit_code, cmd,
+                                               image, res.output)
+        return res
+
+    @classmethod
+    async def run_async(cls, cmd,
+                        conda_env=None,
+                        conda_env_list=[],
+                        conda_root=None,
+                        iterable=False,
+                        read=False,
+                        path_list=[],
+                        threads=None,
+                        **kwargs):
+        """Run command with asyncio.
+
+        Coroutine counterpart of :py:class:`shell` for running many
+        commands concurrently from a single test. Command building
+        (process prefix, PATH and conda activation) is shared with
+        :py:class:`shell`. Containerized runs are not supported.
+
+        Examples:
+
+          .. code-block:: python
+
+             async def index_all(files):
+                 await asyncio.gather(*[shell.run_async("samtools faidx {}".format(f))
+                                        for f in files])
+
+             async def stream(cmd):
+                 proc = await shell.run_async(cmd, iterable=True)
+                 async for line in proc:
+                     print(line)
+                 await proc.wait()
+
+        Args:
+          cmd (str): command string
+          iterable (bool): return :py:class:`AsyncProcess` handle without waiting
+          read (bool): wait and return stdout
+          stream (bool): alias to iterable
+          stdout (int): stdout special value or file descriptor
+          stderr (int): stderr special value or file descriptor; pass
+                        asyncio.subprocess.PIPE to iterate over stderr
+
+        See :py:class:`shell` for remaining arguments.
+
+        Returns:
+          stdout if read is set, an :py:class:`AsyncProcess` if
+          iterable is set, None otherwise
+        """
+        iterable = kwargs.pop("stream", iterable)
+        stdout = asyncio.subprocess.PIPE if iterable or read else kwargs.pop("stdout", None)
+        stderr = kwargs.pop("stderr", None)
+        env = cls._environ(conda_env, conda_root)
+        cmd = cls._command(cmd, conda_env=None if env else conda_env,
+                           conda_env_list=conda_env_list,
+                           conda_root=conda_root, path_list=path_list,
+                           process_prefix=kwargs.pop("process_prefix", None))
+        kwargs.pop("start_new_session", None)
+        token = None
+        if threads:
+            loop = asyncio.get_event_loop()
+            # Run in a copy of the task context so that reservations
+            # held by the task are taken into account
+            token = await loop.run_in_executor(None, contextvars.copy_context().run,
+                                               lambda: jobserver.acquire(cores=threads))
+        try:
+            # Start a new session so that cancelling kills the whole
+            # process group
+            proc = await asyncio.create_subprocess_shell(
+                cmd, stdout=stdout, stderr=stderr, env=env,
+                executable=cls._process_args.get("executable"),
+                start_new_session=True, **kwargs)
+        except BaseException:
+            jobserver.release(token)
+            raise
+        proc = AsyncProcess(proc, cmd, token=token)
+        if iterable:
             return proc
+        if read:
+            out, _ = await proc.communicate()
+            return out
+        await proc.wait()
 
-        return cls.stdout(proc, cmd)
+    @classmethod
+    def _capture(cls, cmd, capture, max_bytes=None, **kwargs):
+        """Run command with stdout and stderr redirected to files in
+        capture directory.
+
+        With max_bytes, output is pumped through pipes and at most
+        max_bytes are written per stream; the process group of the
+        command is killed once a stream exceeds the limit.
+        """
+        fd, stdout = tempfile.mkstemp(prefix="shell-", suffix=".stdout", dir=str(capture))
+        stderr = stdout[:-len(".stdout")] + ".stderr"
+        with os.fdopen(fd, "wb") as out, open(stderr, "wb") as err:
+            if max_bytes is None:
+                proc = _Popen(cmd, stdout=out, stderr=err, **kwargs)
+                proc.wait()
+            else:
+                # Start a new session so that the whole pipeline can be
+                # killed once the output limit is hit
+                proc = _Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, start_new_session=True, **kwargs)
+                tail = cls._pump(proc, {proc.stdout: out, proc.stderr: err}, max_bytes)
+                proc.wait()
+                if tail is not None:
+                    raise OutputLimitExceeded(cmd, max_bytes, stderr=tail.decode(errors="replace"))
+        ret = Capture(stdout, stderr, cmd=cmd, returncode=proc.returncode)
+        if proc.timed_out:
+            raise sp.TimeoutExpired(cmd, proc.timeout, stderr=ret.tail())
+        if proc.returncode:
+            raise sp.CalledProcessError(proc.returncode, cmd, stderr=ret.tail())
+        return ret
+
+    @staticmethod
+    def _pump(proc, streams, max_bytes, nbytes=4096):
+        """Copy process pipes to files, writing at most max_bytes per file.
+
+        Returns:
+          None, or the last nbytes of stderr if the limit was exceeded,
+          in which case the process group has been killed
+        """
+        written = {f: 0 for f in streams}
+        tail, exceeded = b"", False
+        with selectors.DefaultSelector() as selector:
+            for f in streams:
+                selector.register(f, selectors.EVENT_READ)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    f = key.fileobj
+                    chunk = os.read(f.fileno(), CHUNK_SIZE)
+                    if not chunk:
+                        selector.unregister(f)
+                        f.close()
+                        continue
+                    if f is proc.stderr:
+                        tail = (tail + chunk)[-nbytes:]
+                    n = min(len(chunk), max_bytes - written[f])
+                    if n > 0:
+                        streams[f].write(chunk[:n])
+                        written[f] += n
+                    if n < len(chunk) and not exceeded:
+                        exceeded = True
+                        proc.kill_group(grace=0)
+        return tail if exceeded else None
+
+    @classmethod
+    def _run_captured(cls, cmd, container=None, image=None, env=None,
+                      timeout=None, grace=5.0, pool=False, **kwargs):
+        """Run command to completion, capturing stdout and stderr.
+
+        Remaining keyword arguments are passed to exec_run for
+        running containers (user, environment, workdir and privileged
+        only) and to containers.run for images; local commands take
+        none.
+
+        Returns:
+          tuple of return code, stdout and stderr
+
+        Raises:
+          TimeoutExpired: if the command timed out
+          TypeError: on options not supported for the command
+        """
+        if container or image:
+            wrapped = cls._wrap(cmd)
+            if timeout is not None:
+                wrapped = "timeout -s TERM -k {} {} {}".format(int(grace) or 1, timeout, wrapped)
+            if container:
+                unsupported = set(kwargs) - set(_EXEC_RUN_OPTIONS)
+                if unsupported:
+                    raise TypeError("unsupported options for container commands: {}".format(
+                        ", ".join(sorted(unsupported))))
+                res = container.exec_run(wrapped, demux=True, **kwargs)
+                returncode, (out, err) = res.exit_code, res.output
+            elif pool:
+                run_kwargs, exec_kwargs = cls._exec_kwargs(kwargs)
+                with get_pool().lease(image, **run_kwargs) as c:
+                    res = c.exec_run(wrapped, demux=True, **exec_kwargs)
+                returncode, (out, err) = res.exit_code, res.output
+            else:
+                c = get_client().containers.run(image, command=wrapped,
+                                                detach=True, **kwargs)
+                try:
+                    status = c.wait()
+                    returncode = status["StatusCode"] if isinstance(status, dict) else status
+                    out, err = (c.logs(stdout=True, stderr=False),
+                                c.logs(stdout=False, stderr=True))
+                finally:
+                    c.remove(force=True)
+            if timeout is not None and returncode == 124:
+                raise sp.TimeoutExpired(cmd, timeout, output=out, stderr=err)
+            return returncode, out, err
+        if kwargs:
+            raise TypeError("unsupported options for local commands: {}".format(
+                ", ".join(sorted(kwargs))))
+        proc = _Popen(cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE,
+                      close_fds=cls._close_fds(), env=env, timeout=timeout,
+                      grace=grace, **cls._process_args)
+        out, err = proc.communicate()
+        if proc.timed_out:
+            raise sp.TimeoutExpired(cmd, timeout, output=out, stderr=err)
+        return proc.returncode, out, err
+
+    @classmethod
+    def map(cls, cmds,
+            max_workers=None,
+            fail_fast=True,
+            container=None,
+            conda_env=None,
+            conda_env_list=[],
+            conda_root=None,
+            image=None,
+            path_list=[],
+            threads=None,
+            **kwargs):
+        """Run commands concurrently with bounded concurrency.
+
+        Commands are built as in :py:class:`shell` and run to
+        completion, at most max_workers at a time, on the local
+        machine, in a running container (docker exec) or in new
+        containers from an image.
+
+        Examples:
+
+          .. code-block:: python
+
+             results = shell.map(["samtools faidx {}".format(f) for f in files],
+                                 fail_fast=False)
+             failed = [r.cmd for r in results if r.returncode]
+
+        Args:
+          cmds (list): command strings
+          max_workers (int): maximum number of concurrent commands;
+                             defaults to the number of ngs threads
+          fail_fast (bool): raise on first failure and skip pending
+                            commands; otherwise run all commands and
+                            report failures in the results
+          threads (int): cores to reserve from the job server for
+                         each command
+          timeout (float): per-command timeout in seconds; commands
+                           that time out are reported with return
+                           code 124 unless fail_fast is set
+          grace (float): seconds between SIGTERM and SIGKILL on timeout
+          pool (bool): run image commands in pooled containers
+
+        See :py:class:`shell` for remaining arguments. Other options
+        are passed to docker for container and image commands, and
+        rejected for local commands.
+
+        Returns:
+          list of :py:class:`Result` in the order of cmds
+
+        Raises:
+          CalledProcessError: if fail_fast is set and a command fails
+          TimeoutExpired: if fail_fast is set and a command times out
+        """
+        conda_root = conda_root or (get_conda_root() if conda_env_list else None)
+        process_prefix = kwargs.pop("process_prefix", None)
+        env = None if container or image else cls._environ(conda_env, conda_root)
+        built = [cls._command(c, conda_env=None if env else conda_env,
+                              conda_env_list=conda_env_list,
+                              conda_root=conda_root, path_list=path_list,
+                              process_prefix=process_prefix) for c in cmds]
+
+        def _run(i):
+            start = time.time()
+            token = jobserver.acquire(cores=threads) if threads else None
+            try:
+                returncode, out, err = cls._run_captured(built[i], container=container,
+                                                         image=image, env=env, **kwargs)
+            except sp.TimeoutExpired as e:
+                if fail_fast:
+                    raise
+                returncode, out, err = 124, e.output, e.stderr
+            finally:
+                jobserver.release(token)
+            return Result(cmds[i], returncode, time.time() - start,
+                          out.decode() if out is not None else None,
+                          err.decode() if err is not None else None)
+
+        results = [None] * len(built)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or cls._threads) as executor:
+            # Commands nest in reservations held by the caller
+            futures = {executor.submit(contextvars.copy_context().run, _run, i): i
+                       for i in range(len(built))}
+            for f in concurrent.futures.as_completed(futures):
+                try:
+                    r = f.result()
+                except sp.TimeoutExpired:
+                    for g in futures:
+                        g.cancel()
+                    raise
+                results[futures[f]] = r
+                if fail_fast and r.returncode:
+                    for g in futures:
+                        g.cancel()
+                    raise sp.CalledProcessError(r.returncode, built[futures[f]],
+                                                output=r.stdout, stderr=r.stderr)
+        return results
+
+    @staticmethod
+    def _release_after(it, token):
+        try:
+            yield from it
+        finally:
+            jobserver.release(token)
 
     @staticmethod
     def stdout(proc, cmd, ret=None):
-        if isinstance(proc, sp.Popen):
+        if isinstance(proc, _Popen):
+            try:
+                proc.wait()
+            except BaseException:
+                # Do not leave the process group behind on interrupt
+                proc.kill_group()
+                raise
+            proc.check()
+            return ret
+        elif isinstance(proc, sp.Popen):
             retcode = proc.wait()
             if retcode:
                 raise sp.CalledProcessError(retcode, cmd)
@@ -190,38 +1671,41 @@ class shell:
             return proc.decode()
 
     @staticmethod
-    def iter_stdout(proc, cmd):
-        if isinstance(proc, types.GeneratorType):
-            for l in proc:
-                if isinstance(l, bytes):
-                    for k in l.decode().split("\n"):
-                        yield k
-                else:
-                    yield l[:-1]
-            raise StopIteration
+    def iter_stdout(proc, cmd, encoding="utf-8"):
+        """Iterate over output lines of a process.
+
+        Output is consumed in chunks and split into lines
+        incrementally, so memory use is bounded by the chunk size and
+        the longest line rather than the total output size.
+
+        Args:
+          proc: process, container, exec result, container stream,
+                generator or output
+          cmd (str): command string, used in error messages
+          encoding (str): output encoding; if None, yield bytes
+        """
+        if isinstance(proc, ContainerStream):
+            yield from proc
+            proc.check()
+            return
+        if isinstance(proc, ExecResult):
+            proc = proc.output
+        if isinstance(proc, str):
+            return
+        if isinstance(proc, bytes):
+            yield from iter_lines([proc], encoding)
+        elif isinstance(proc, types.GeneratorType):
+            yield from iter_lines(proc, encoding)
         elif isinstance(proc, Container):
-            for l in proc.logs(stream=True):
-                yield l[:-1].decode()
-            raise StopIteration
-        elif isinstance(proc, ExecResult):
-            for l in proc.output:
-                if isinstance(l, bytes):
-                    for k in l.decode().split("\n"):
-                        yield k
-                else:
-                    yield l[:-1].decode()
-            raise StopIteration
-        elif isinstance(proc, bytes):
-            for l in proc.decode().split("\n"):
-                yield l
-            raise StopIteration
-        elif isinstance(proc, str):
-            return proc
-        for l in proc.stdout:
-            yield l[:-1].decode()
-        retcode = proc.wait()
-        if retcode:
-            raise sp.CalledProcessError(retcode, cmd)
+            yield from iter_lines(proc.logs(stream=True), encoding)
+        else:
+            try:
+                yield from iter_lines(iter(lambda: proc.stdout.read1(CHUNK_SIZE), b""), encoding)
+            except BaseException:
+                if isinstance(proc, _Popen):
+                    proc.kill_group()
+                raise
+            shell.stdout(proc, cmd)
 
 
 if "SHELL" in os.environ:
@@ -3,6 +3,7 @@ import os
 import docker
 import pytest
 from pytest_ngsfixtures.wm.snakemake import snakefile, run as snakemake_run
+from pytest_ngsfixtures.container import get_client
 
 
 @pytest.fixture(scope="session")
@@ -16,7 +17,7 @@ def container(request):
         finally:
             pass
     request.addfinalizer(rm)
-    client = docker.from_env()
+    client = get_client()
     try:
         image = client.images.get(pytest.snakemake_image)
     except docker.errors.ImageNotFound:
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Per-rule performance metrics of workflow runs.
+
+Metrics are harvested from the benchmark files written by rules with
+a benchmark directive, and from the job start and end times snakemake
+keeps in .snakemake/metadata. Metrics of all runs in a test are
+collected per rule and attached to the test report.
+"""
+import os
+import re
+import csv
+import json
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Benchmark columns, in seconds, megabytes and as a fraction of a CPU
+FIELDS = ("s", "max_rss", "max_vms", "io_in", "io_out", "mean_load", "cpu_time")
+
+_RULE_RE = re.compile(r"^(?:local)?(?:rule|checkpoint)\s+(\w+)\s*:", re.MULTILINE)
+_BENCHMARK_RE = re.compile(r"^\s+benchmark:\s*(?:repeat\()?\s*[\"'](.+?)[\"']", re.MULTILINE)
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def parse_rules(text):
+    """Return benchmark file patterns by rule name in snakefile text"""
+    patterns = {}
+    headers = list(_RULE_RE.finditer(text))
+    for i, m in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(text)
+        b = _BENCHMARK_RE.search(text, m.end(), end)
+        if b:
+            patterns[m.group(1)] = b.group(1)
+    return patterns
+
+
+def _regex(pattern):
+    """Convert a pattern with {wildcards} to a regular expression"""
+    parts = re.split(r"\{[^}]+\}", pattern)
+    return re.compile("^" + ".+".join(re.escape(p) for p in parts) + "$")
+
+
+def parse_benchmark(path):
+    """Parse a benchmark file.
+
+    Returns:
+      list of dictionaries, one per repetition, of the numeric
+      fields in FIELDS; missing values are left out
+    """
+    rows = []
+    with open(path) as fh:
+        for row in csv.DictReader(fh, delimiter="\t"):
+            values = {}
+            for k in FIELDS:
+                try:
+                    values[k] = float(row[k])
+                except (KeyError, TypeError, ValueError):
+                    continue
+            rows.append(values)
+    return rows
+
+
+def parse_metadata(workdir, since=None):
+    """Return job wall times in seconds by rule from .snakemake/metadata.
+
+    Args:
+      workdir (str): snakemake working directory
+      since (float): only consider jobs that ended at or after since
+    """
+    times = {}
+    metadir = os.path.join(str(workdir), ".snakemake", "metadata")
+    try:
+        names = os.listdir(metadir)
+    except OSError:
+        return times
+    for name in names:
+        try:
+            with open(os.path.join(metadir, name)) as fh:
+                record = json.load(fh)
+            start, end = float(record["starttime"]), float(record["endtime"])
+            rule = record["rule"]
+        except (OSError, ValueError, KeyError, TypeError):
+            continue
+        if since is not None and end < since:
+            continue
+        times.setdefault(rule, []).append(end - start)
+    return times
+
+
+def harvest(workdir, patterns, since=None):
+    """Collect per-rule metrics of a run in workdir.
+
+    Benchmark values are the maxima over the jobs and repetitions of a
+    rule; wall_s is the longest job wall time recorded in the
+    snakemake metadata, and jobs the number of benchmarked jobs.
+
+    Args:
+      workdir (str): snakemake working directory
+      patterns (dict): benchmark file patterns by rule, see :py:func:`parse_rules`
+      since (float): ignore files and jobs older than since
+
+    Returns:
+      dict of metrics dictionaries by rule
+    """
+    workdir = str(workdir)
+    regexes = {rule: _regex(p) for rule, p in patterns.items()}
+    metrics = {}
+    for root, dirs, files in os.walk(workdir) if regexes else ():
+        dirs[:] = [d for d in dirs if d != ".snakemake"]
+        for f in files:
+            path = os.path.join(root, f)
+            relpath = os.path.relpath(path, workdir)
+            rule = next((r for r, rx in regexes.items() if rx.match(relpath)), None)
+            if rule is None:
+                continue
+            try:
+                if since is not None and os.stat(path).st_mtime < since:
+                    continue
+                rows = parse_benchmark(path)
+            except OSError as e:
+                logger.warning("failed to read benchmark file {}: {}".format(path, e))
+                continue
+            m = metrics.setdefault(rule, {'jobs': 0})
+            m['jobs'] += 1
+            for row in rows:
+                for k, v in row.items():
+                    m[k] = max(m.get(k, v), v)
+    for rule, times in parse_metadata(workdir, since=since).items():
+        metrics.setdefault(rule, {'jobs': 0})['wall_s'] = max(times)
+    return metrics
+
+
+def _record(metrics):
+    with _metrics_lock:
+        for rule, m in metrics.items():
+            current = _metrics.setdefault(rule, {})
+            for k, v in m.items():
+                if k == "jobs":
+                    current[k] = current.get(k, 0) + v
+                else:
+                    current[k] = max(current.get(k, v), v)
+
+
+def metrics(reset=False):
+    """Return per-rule metrics of the workflow runs since the last reset.
+
+    Args:
+      reset (bool): clear the collected metrics
+
+    Returns:
+      dict of metrics dictionaries by rule
+    """
+    with _metrics_lock:
+        ret = {rule: dict(m) for rule, m in _metrics.items()}
+        if reset:
+            _metrics.clear()
+    return ret
+
+
+def check(metrics, rule, max_s=None, max_rss_mb=None):
+    """Return a list of threshold violations of rule in metrics.
+
+    max_s is compared to the benchmark running time, or to the job
+    wall time if the rule has no benchmark directive.
+    """
+    m = metrics.get(rule)
+    if m is None:
+        return ["no metrics recorded for rule '{}'".format(rule)]
+    errors = []
+    seconds = m.get('s', m.get('wall_s'))
+    if max_s is not None:
+        if seconds is None:
+            errors.append("no running time recorded for rule '{}'".format(rule))
+        elif seconds > max_s:
+            errors.append("rule '{}' ran for {:.2f}s > {}s".format(rule, seconds, max_s))
+    if max_rss_mb is not None:
+        if m.get('max_rss') is None:
+            errors.append("no memory usage recorded for rule '{}'; add a benchmark directive".format(rule))
+        elif m['max_rss'] > max_rss_mb:
+            errors.append("rule '{}' used {:.0f}MB > {}MB".format(rule, m['max_rss'], max_rss_mb))
+    return errors
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Content-addressed store for workflow outputs.
+
+Output files are stored once per content hash under objects/, and
+each successful run is recorded as a manifest under keys/ that maps
+output paths relative to the working directory to object hashes.
+Manifests are touched when used, so that the least recently used runs
+are evicted first once the store exceeds its size cap.
+"""
+import os
+import json
+import shutil
+import hashlib
+import threading
+import logging
+from pytest_ngsfixtures.config import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_CACHE_DIR = CACHE_DIR / "outputs"
+MAX_MB = 10240
+
+
+def _tmp(path):
+    return "{}.{}.{}".format(path, os.getpid(), threading.get_ident())
+
+
+def _digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(2**20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class OutputCache:
+    """Content-addressed output store with a least recently used size cap.
+
+    Args:
+      root (str): store directory
+      max_mb (int): size cap in megabytes
+
+    Examples:
+
+      .. code-block:: python
+
+         outputs = OutputCache("/path/to/store")
+         if not outputs.restore(key, workdir):
+             shell("make -C {}".format(workdir))
+             outputs.store(key, workdir, ["result.txt"])
+    """
+    def __init__(self, root=OUTPUT_CACHE_DIR, max_mb=MAX_MB):
+        self.root = str(root)
+        self.max_mb = max_mb
+        self._lock = threading.Lock()
+
+    def _object(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def _manifest(self, key):
+        return os.path.join(self.root, "keys", "{}.json".format(key))
+
+    def restore(self, key, workdir):
+        """Restore the outputs recorded for key into workdir.
+
+        Returns:
+          True if the outputs were restored, False on a cache miss
+        """
+        manifest = self._manifest(key)
+        try:
+            with open(manifest) as fh:
+                files = json.load(fh)
+            for relpath, (digest, mode) in files.items():
+                if not os.path.exists(self._object(digest)):
+                    return False
+            for relpath, (digest, mode) in files.items():
+                dst = os.path.join(str(workdir), relpath)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                tmp = _tmp(dst)
+                shutil.copyfile(self._object(digest), tmp)
+                os.chmod(tmp, mode)
+                os.replace(tmp, dst)
+            os.utime(manifest)
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning("failed to restore cached outputs for {}: {}".format(key, e))
+            return False
+        logger.info("restored {} cached output(s) for {}".format(len(files), key))
+        return True
+
+    def store(self, key, workdir, paths):
+        """Store paths, relative to workdir, as the outputs of key"""
+        files = {}
+        try:
+            for relpath in paths:
+                src = os.path.join(str(workdir), relpath)
+                digest = _digest(src)
+                obj = self._object(digest)
+                if not os.path.exists(obj):
+                    os.makedirs(os.path.dirname(obj), exist_ok=True)
+                    tmp = _tmp(obj)
+                    shutil.copyfile(src, tmp)
+                    os.replace(tmp, obj)
+                files[relpath] = (digest, os.stat(src).st_mode & 0o7777)
+            manifest = self._manifest(key)
+            os.makedirs(os.path.dirname(manifest), exist_ok=True)
+            tmp = _tmp(manifest)
+            with open(tmp, "w") as fh:
+                json.dump(files, fh)
+            os.replace(tmp, manifest)
+        except OSError as e:
+            logger.warning("failed to cache outputs for {}: {}".format(key, e))
+            return
+        self.prune()
+
+    def size(self):
+        """Return the total size of stored objects in bytes"""
+        total = 0
+        for root, dirs, files in os.walk(os.path.join(self.root, "objects")):
+            total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        return total
+
+    def prune(self, max_mb=None):
+        """Evict least recently used manifests and unreferenced objects
+        until the store fits max_mb megabytes"""
+        max_bytes = (self.max_mb if max_mb is None else max_mb) * 2**20
+        with self._lock:
+            keydir = os.path.join(self.root, "keys")
+            try:
+                manifests = sorted((os.path.join(keydir, f) for f in os.listdir(keydir)),
+                                   key=os.path.getmtime)
+            except OSError:
+                return
+            while manifests and self.size() > max_bytes:
+                try:
+                    os.remove(manifests.pop(0))
+                except FileNotFoundError:
+                    pass
+                self._collect(manifests)
+
+    def _collect(self, manifests):
+        """Remove objects not referenced by manifests"""
+        referenced = set()
+        for m in manifests:
+            try:
+                with open(m) as fh:
+                    referenced.update(d for d, mode in json.load(fh).values())
+            except (OSError, ValueError):
+                continue
+        for root, dirs, files in os.walk(os.path.join(self.root, "objects")):
+            for f in files:
+                # Skip objects that are still being written
+                if f not in referenced and "." not in f:
+                    try:
+                        os.remove(os.path.join(root, f))
+                    except FileNotFoundError:
+                        pass
+
+
+_output_cache = OutputCache()
+_enabled = True
+
+
+def configure(enabled=True, root=OUTPUT_CACHE_DIR, max_mb=MAX_MB):
+    """Setup the process-wide output cache used by snakemake.run"""
+    global _output_cache, _enabled
+    _enabled = enabled
+    _output_cache = OutputCache(root, max_mb=max_mb)
+    return _output_cache
+
+
+def get_output_cache():
+    """Return the process-wide output cache, or None if disabled"""
+    return _output_cache if _enabled else None
@@ -1,18 +1,54 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
+import re
+import time
+import json
+import shlex
+import hashlib
 import inspect
+import threading
+import fcntl
+import collections
+import contextlib
+import concurrent.futures
+import subprocess as sp
 import pytest
 import py
 import logging
 from pytest_ngsfixtures.os import safe_mktemp, safe_copy, safe_symlink
-from pytest_ngsfixtures.shell import shell
+from pytest_ngsfixtures.shell import shell, Usage, _record
 from pytest_ngsfixtures.wm.utils import save_command
+from pytest_ngsfixtures.wm.cache import get_output_cache
+from pytest_ngsfixtures.wm import benchmark
+from pytest_ngsfixtures.config import CACHE_DIR
+from pytest_ngsfixtures.container import get_image
+from pytest_ngsfixtures import jobserver
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+BACKEND = os.environ.get("PYTEST_NGSFIXTURES_SNAKEMAKE_BACKEND", "shell")
+
+# shell options honoured by the in-process backend; any other shell
+# option (containers, output redirection, timeouts, ...) requires
+# running snakemake in a subprocess
+_API_OPTIONS = ("threads",)
+
+# shell options that select where and how snakemake is executed
+_EXECUTION_OPTIONS = ("conda_env", "conda_env_list", "path_list")
+
+# shell options whose runs can not be cached
+_STREAMING_OPTIONS = ("read", "iterable", "async_", "stream", "detach")
+
+# The working directory and snakemake logging are process-wide
+_api_lock = threading.Lock()
+
+# Deployment prefixes shared by all snakemake runs on the machine
+CONDA_PREFIX = CACHE_DIR / "snakemake" / "conda"
+SINGULARITY_PREFIX = CACHE_DIR / "snakemake" / "singularity"
+
 
 @pytest.fixture
 def snakefile(request, tmpdir_factory):
@@ -48,8 +84,86 @@ def snakefile(request, tmpdir_factory):
     return dst
 
 
+def _cores(options):
+    """Return the number of cores requested in snakemake options, or
+    None if not set"""
+    args = shlex.split(" ".join(options))
+    for i, a in enumerate(args):
+        for opt in ("--cores", "--jobs", "-j"):
+            if a == opt:
+                nxt = args[i + 1] if i + 1 < len(args) else ""
+                return int(nxt) if nxt.isdigit() else os.cpu_count()
+            if a.startswith(opt + "=") or (opt == "-j" and a[2:].isdigit()):
+                value = a[len(opt):].lstrip("=")
+                return int(value) if value.isdigit() else os.cpu_count()
+    return None
+
+
+def _directory(options):
+    """Return the working directory set in snakemake options, or None"""
+    args = shlex.split(" ".join(options))
+    for i, a in enumerate(args):
+        if a in ("-d", "--directory") and i + 1 < len(args):
+            return args[i + 1]
+        if a.startswith("--directory="):
+            return a.split("=", 1)[1]
+    return None
+
+
+def _snakemake_main():
+    try:
+        from snakemake.cli import main
+    except ImportError:
+        from snakemake import main
+    return main
+
+
+def _run_api(argv, threads=None):
+    """Run snakemake command line argv in this process.
+
+    Raises:
+      CalledProcessError: if snakemake exits with a non-zero status
+    """
+    main = _snakemake_main()
+    cmd = " ".join(shlex.quote(a) for a in argv)
+    loggers = [logging.getLogger(name) for name in ("snakemake", "snakemake.logging")]
+    token = jobserver.acquire(cores=threads) if threads else None
+    try:
+        with _api_lock:
+            start = time.time()
+            cwd = os.getcwd()
+            handlers = [list(lg.handlers) for lg in loggers]
+            try:
+                main(argv[1:])
+                returncode = 0
+            except SystemExit as e:
+                returncode = e.code if isinstance(e.code, int) else int(e.code is not None)
+            finally:
+                os.chdir(cwd)
+                for lg, h in zip(loggers, handlers):
+                    lg.handlers[:] = h
+            _record(Usage(cmd, time.time() - start, None, None, None))
+    finally:
+        jobserver.release(token)
+    if returncode:
+        raise sp.CalledProcessError(returncode, cmd)
+
+
+def _shared_prefixes(options):
+    """Return options that point conda and singularity deployments of
+    snakemake to the shared prefixes"""
+    joined = " ".join(options)
+    extra = []
+    for flag, option, prefix in (("--use-conda", "--conda-prefix", CONDA_PREFIX),
+                                 ("--use-singularity", "--singularity-prefix", SINGULARITY_PREFIX)):
+        if flag in joined and option not in joined:
+            prefix.mkdir(parents=True, exist_ok=True)
+            extra += [option, str(prefix)]
+    return extra
+
+
 def run(snakefile, target="all",
-        save=False, **kwargs):
+        save=False, mounts=None, backend=None, cache=False, **kwargs):
     """Run snakemake on snakefile.
 
     Wraps snakefile in a command string and pass the string to shell
@@ -65,24 +179,561 @@ def run(snakefile, target="all",
                                 options=["--ri -k"], iterable=True):
              print(r)
 
+         results = snakemake.run("/path/to/Snakefile",
+                                 target=["s1.bam", "multiqc"])
+         assert results["s1.bam"].success
+
     Args:
       snakefile (str, py._path.local.LocalPath): snakefile full path name
-      target (str): snakemake target to run
+      target (str, list): snakemake target to run, or a list of
+                          targets to run in one snakemake invocation;
+                          see :py:func:`run_targets`
       options (list): options to pass to snakemake
       save (bool): save shell script with command
+      mounts (bool, list): for image runs, bind mount the snakefile
+                           and working directories, plus any paths
+                           listed (e.g. samples and ref fixtures), at
+                           their host locations instead of relying on
+                           volumes; the package data directory is
+                           mounted read-only so that symlinked
+                           fixture data resolves in the container
+      cache (bool): restore the outputs of a previous successful run
+                    with the same snakefile, included files,
+                    configfiles, target, options, working directory
+                    contents and execution environment (backend,
+                    container or image ID, conda and path options)
+                    from the output cache instead
+                    of running snakemake; see
+                    :py:mod:`pytest_ngsfixtures.wm.cache`. Ignored
+                    for read, iterable and async runs, and when the
+                    cache is disabled with --ngs-no-cache
+      backend (str): 'shell' runs snakemake in a subprocess via
+                     :py:class:`~pytest_ngsfixtures.shell.shell`;
+                     'api' runs it in the test process through the
+                     snakemake command line entry point, saving
+                     interpreter startup and snakemake import time.
+                     Runs with any other shell option (containers,
+                     read, iterable, async, timeout, stdout, stderr,
+                     capture, conda or path options) fall back to
+                     'shell', so that they behave the same with
+                     either backend. Defaults to the
+                     PYTEST_NGSFIXTURES_SNAKEMAKE_BACKEND environment
+                     variable, or 'shell'
+
+    The number of cores passed via -j/--cores is reserved from the
+    job server for the duration of the run unless threads is given
+    explicitly. If the calling test declares resources with
+    pytest.mark.ngs_resources, they are passed on as --cores and
+    --resources unless already present in options.
+
+    With --use-conda or --use-singularity, environments and images are
+    kept in prefixes below CACHE_DIR shared by all runs on the machine,
+    unless --conda-prefix or --singularity-prefix is given. Conda
+    environments missing from the shared prefix are first created under
+    per-environment locks, see :py:func:`create_conda_envs`.
+
+    After runs that do not stream output, per-rule metrics are
+    harvested from benchmark files and .snakemake/metadata in the
+    working directory, see :py:mod:`pytest_ngsfixtures.wm.benchmark`.
+    Runs restored from the output cache report the metrics of the
+    benchmark files restored with the outputs.
+
+    Pass timeout (seconds) to bound the wall time of the run; on
+    expiry snakemake and all jobs it spawned are terminated, see
+    :py:class:`~pytest_ngsfixtures.shell.shell`.
 
     Kwargs:
       See :py:mod:`pytest_ngsfixtures.shell.shell` documentation.
 
     Returns:
-      Results from :py:mod:`~pytest_ngsfixtures.shell.shell`.
+      Results from :py:mod:`~pytest_ngsfixtures.shell.shell`, or
+      for a list of targets, a dictionary of :py:class:`TargetResult`
+      by target.
 
     """
-    options = kwargs.pop("options", [])
+    if isinstance(target, (list, tuple)):
+        return run_targets(snakefile, target, save=save, mounts=mounts,
+                           backend=backend, cache=cache, **kwargs)
+    options = list(kwargs.pop("options", []))
     if not {"--directory", "-d"}.intersection(options):
         options += ["-d", py.path.local(snakefile).dirname]
+    held = jobserver.held()
+    if held.get("cores") and _cores(options) is None:
+        options += ["--cores", str(held["cores"])]
+    resources = ["{}={}".format(k, held[k]) for k in ("mem_mb", "disk_mb") if held.get(k)]
+    if resources and "--resources" not in " ".join(options):
+        options += ["--resources"] + resources
+    prefixes = _shared_prefixes(options)
+    options += prefixes
+    if "--conda-prefix" in prefixes and "--conda-create-envs-only" not in options:
+        # Build missing environments under their locks before the run
+        # uses the shared prefix
+        _create_envs(snakefile, options, backend=backend, mounts=mounts,
+                     **{k: v for k, v in kwargs.items()
+                        if k not in _STREAMING_OPTIONS and k != "threads"})
     cmd_args = ["snakemake", "-s", str(snakefile), target] + options
     cmd = " ".join(cmd_args)
     if save:
         save_command(cmd, outfile=os.path.join(os.path.dirname(str(snakefile)), "command.sh"))
+    kwargs.setdefault("threads", _cores(options) or 1)
+    if mounts:
+        paths = [snakefile, _directory(options)] + prefixes[1::2]
+        if mounts is not True:
+            paths += list(mounts)
+        kwargs["mounts"] = paths
+    if any(kwargs.get(k) for k in _STREAMING_OPTIONS):
+        return _execute(cmd, backend, **kwargs)
+    outputs = get_output_cache() if cache else None
+    workdir = _directory(options)
+    if outputs is not None:
+        key = _dryrun_key(snakefile, target, options,
+                          extra=_execution(backend, kwargs))
+        if outputs.restore(key, workdir):
+            # The restored benchmark files hold the metrics of the
+            # cached run, whatever their age
+            benchmark._record(benchmark.harvest(workdir, _benchmarks(snakefile, options)))
+            return None
+        before = {e[0]: e[1:] for e in _manifest(workdir)}
+    start = time.time()
+    try:
+        ret = _execute(cmd, backend, **kwargs)
+    finally:
+        benchmark._record(benchmark.harvest(workdir, _benchmarks(snakefile, options), since=start))
+    if outputs is not None:
+        outputs.store(key, workdir, [e[0] for e in _manifest(workdir)
+                                     if before.get(e[0]) != e[1:]])
+    return ret
+
+
+def _image_id(image):
+    """Return the ID of image, given as name or image object"""
+    if not isinstance(image, str):
+        return getattr(image, "id", str(image))
+    try:
+        return get_image(image, pull=False).id
+    except Exception:
+        return image
+
+
+def _execution(backend, kwargs):
+    """Return the execution environment of a run, for cache keys"""
+    container = kwargs.get("container")
+    image = kwargs.get("image")
+    if container:
+        container = getattr(container, "attrs", {}).get("Image") or getattr(container, "id", None)
+    return {
+        'backend': backend or BACKEND,
+        'container': container or None,
+        'image': _image_id(image) if image else None,
+        **{k: kwargs.get(k) for k in _EXECUTION_OPTIONS},
+    }
+
+
+def _execute(cmd, backend=None, **kwargs):
+    if (backend or BACKEND) == "api":
+        subprocess_options = sorted(k for k, v in kwargs.items() if v and k not in _API_OPTIONS)
+        if not subprocess_options:
+            return _run_api(shlex.split(cmd), threads=kwargs.get("threads"))
+        logger.debug("running snakemake in a subprocess due to {}".format(
+            ", ".join(subprocess_options)))
     return shell(cmd, **kwargs)
+
+
+Job = collections.namedtuple("Job", ["rule", "jobid", "input", "output", "wildcards", "reason"])
+Job.__doc__ = """Job planned by a snakemake dry run.
+
+input and output are lists of file names and wildcards a dictionary
+of wildcard values.
+"""
+
+_RULE_RE = re.compile(r"^(?:local)?(?:rule|checkpoint) (\S+):\s*$")
+_FIELD_RE = re.compile(r"^\s+(\w+): (.*)$")
+_RULE_DEF_RE = re.compile(r"^(?:local)?(?:rule|checkpoint)\s+(\w+)\s*:", re.MULTILINE)
+_CONDA_RE = re.compile(r"^\s*conda:\s*[\"'](.+)[\"']", re.MULTILINE)
+_INCLUDE_RE = re.compile(r"^\s*(include|configfile):\s*[\"'](.+)[\"']", re.MULTILINE)
+
+# Dry-run results by cache key
+_dryruns = {}
+
+# Larger files are keyed on size and modification time instead of content
+DIGEST_MAX_BYTES = 2**20
+
+
+def parse_dryrun(output):
+    """Parse jobs from the output of snakemake -n -r.
+
+    Args:
+      output (str): dry-run output
+
+    Returns:
+      list of :py:class:`Job`
+    """
+    jobs = []
+    job = None
+    for line in output.splitlines():
+        m = _RULE_RE.match(line)
+        if m:
+            job = {'rule': m.group(1)}
+            jobs.append(job)
+            continue
+        m = _FIELD_RE.match(line) if job is not None else None
+        if m:
+            job[m.group(1)] = m.group(2).strip()
+        else:
+            job = None
+
+    def _split(value):
+        return [x for x in (value or "").split(", ") if x]
+    return [Job(j['rule'], int(j['jobid']) if j.get('jobid', '').isdigit() else None,
+                _split(j.get('input')), _split(j.get('output')),
+                dict(w.split("=", 1) for w in _split(j.get('wildcards')) if "=" in w),
+                j.get('reason')) for j in jobs]
+
+
+def _dependencies(snakefile, options):
+    """Return the snakefile, its included files and configfiles"""
+    files, todo = [], [(str(snakefile), "include")]
+    while todo:
+        f, kind = todo.pop()
+        f = os.path.abspath(f)
+        if f in files:
+            continue
+        files.append(f)
+        if kind != "include":
+            continue
+        try:
+            with open(f) as fh:
+                text = fh.read()
+        except OSError:
+            continue
+        todo.extend((os.path.join(os.path.dirname(f), m.group(2)), m.group(1))
+                    for m in _INCLUDE_RE.finditer(text))
+    args = shlex.split(" ".join(options))
+    for i, a in enumerate(args):
+        if a in ("--configfile", "--configfiles"):
+            for x in args[i + 1:]:
+                if x.startswith("-"):
+                    break
+                files.append(os.path.abspath(x))
+    return files
+
+
+def _rules(snakefile, options):
+    """Return the names of the rules defined in snakefile and its
+    included files"""
+    names = set()
+    for f in _dependencies(snakefile, options):
+        try:
+            with open(f) as fh:
+                names.update(m.group(1) for m in _RULE_DEF_RE.finditer(fh.read()))
+        except OSError:
+            continue
+    return names
+
+
+def _benchmarks(snakefile, options):
+    """Return benchmark file patterns by rule of snakefile and its
+    included files"""
+    patterns = {}
+    for f in _dependencies(snakefile, options):
+        try:
+            with open(f) as fh:
+                patterns.update(benchmark.parse_rules(fh.read()))
+        except OSError:
+            continue
+    return patterns
+
+
+def _manifest(workdir, content=False):
+    """Yield relative path, size and modification time of files below
+    workdir. If content is set, yield a content digest instead of the
+    modification time of regular files of at most DIGEST_MAX_BYTES,
+    and add the link target to the modification time of symbolic
+    links"""
+    for root, dirs, filenames in os.walk(workdir):
+        dirs[:] = sorted(d for d in dirs if d != ".snakemake")
+        for f in sorted(filenames):
+            path = os.path.join(root, f)
+            try:
+                st = os.stat(path)
+                if not content or st.st_size > DIGEST_MAX_BYTES and not os.path.islink(path):
+                    stamp = st.st_mtime_ns
+                elif os.path.islink(path):
+                    stamp = (os.path.realpath(path), st.st_mtime_ns)
+                else:
+                    h = hashlib.sha256()
+                    with open(path, "rb") as fh:
+                        for chunk in iter(lambda: fh.read(2**20), b""):
+                            h.update(chunk)
+                    stamp = h.hexdigest()
+            except OSError:
+                continue
+            yield os.path.relpath(path, workdir), st.st_size, stamp
+
+
+def _dryrun_key(snakefile, target, options, extra=None):
+    """Return a hash of the snakefile, its dependencies, target,
+    options, working directory contents and any extra JSON-serializable
+    value. Snakefile and working directory locations, and modification
+    times of small copied files, are left out, so that identical
+    layouts in different temporary directories share keys. Large files
+    are keyed on size and modification time so that computing the key
+    does not read them"""
+    workdir = os.path.abspath(_directory(options) or os.path.dirname(str(snakefile)))
+    sfdir = os.path.dirname(os.path.abspath(str(snakefile)))
+
+    def _relative(x):
+        return x.replace(workdir, "{workdir}").replace(sfdir, "{snakefile_dir}")
+    h = hashlib.sha256()
+    h.update(json.dumps([str(target), [_relative(str(o)) for o in options], extra],
+                        sort_keys=True, default=str).encode())
+    for f in _dependencies(snakefile, options):
+        h.update(_relative(f).encode())
+        try:
+            with open(f, "rb") as fh:
+                h.update(fh.read())
+        except OSError:
+            h.update(b"\0")
+    for entry in _manifest(workdir, content=True):
+        h.update(_relative(repr(entry)).encode())
+    return h.hexdigest()
+
+
+def dryrun(snakefile, target="all", cache=True, **kwargs):
+    """Plan a snakemake run without executing it.
+
+    Runs snakemake -n -r and parses the planned jobs. Results are
+    cached in memory and in CACHE_DIR, keyed on the contents of the
+    snakefile, its included files and configfiles, the target and
+    options, and a manifest of the files in the working directory:
+    path, size and content hash of files up to DIGEST_MAX_BYTES, link
+    targets of symbolic links, and modification times of larger files.
+    Cache hits do not run snakemake.
+
+    Examples:
+
+      .. code-block:: python
+
+         from pytest_ngsfixtures.wm import snakemake
+
+         jobs = snakemake.dryrun(snakefile, target="s1.bam",
+                                 options=["-d", str(samples)])
+         assert [j.rule for j in jobs] == ["bwa_mem", "all"]
+
+    Args:
+      snakefile (str, py._path.local.LocalPath): snakefile full path name
+      target (str): snakemake target
+      cache (bool): use cached dry-run results
+
+    Kwargs:
+      See :py:func:`run`.
+
+    Returns:
+      list of :py:class:`Job`
+    """
+    options = list(kwargs.pop("options", []))
+    if not {"--directory", "-d"}.intersection(options):
+        options += ["-d", py.path.local(snakefile).dirname]
+    key = _dryrun_key(snakefile, target, options) if cache else None
+    cachefile = CACHE_DIR / "dryrun" / "{}.json".format(key)
+    if key in _dryruns:
+        return list(_dryruns[key])
+    if key is not None:
+        try:
+            with open(str(cachefile)) as fh:
+                jobs = [Job(**j) for j in json.load(fh)]
+            _dryruns[key] = jobs
+            return list(jobs)
+        except (OSError, ValueError, TypeError):
+            pass
+    kwargs.setdefault("threads", None)
+    output = run(snakefile, target=target, options=options + ["-n", "-r"],
+                 read=True, stderr=sp.STDOUT, **kwargs)
+    jobs = parse_dryrun(output)
+    if key is not None:
+        _dryruns[key] = jobs
+        try:
+            cachefile.parent.mkdir(parents=True, exist_ok=True)
+            tmp = "{}.{}".format(cachefile, os.getpid())
+            with open(tmp, "w") as fh:
+                json.dump([j._asdict() for j in jobs], fh)
+            os.replace(tmp, str(cachefile))
+        except OSError as e:
+            logger.warning("Failed to cache dry run: {}".format(e))
+    return list(jobs)
+
+
+TargetResult = collections.namedtuple("TargetResult", ["success", "outputs"])
+TargetResult.__doc__ = """Outcome of a target run by :py:func:`run_targets`.
+
+success is True if all outputs exist after the run, and outputs is
+the list of output paths of the target.
+"""
+
+
+def run_targets(snakefile, targets, **kwargs):
+    """Run several snakemake targets in one invocation.
+
+    The workflow is parsed and its DAG built once for all targets.
+    Unless set in options, snakemake runs with --keep-going, so that
+    a failing target does not stop the others, and with as many cores
+    as set by --ngs-threads. A target that names a file maps to that
+    file. A target that names a rule of the snakefile maps to the
+    outputs of all jobs of that rule, which are planned with a
+    (cached) :py:func:`dryrun` of the rule targets only; runs of file
+    targets start snakemake once. Targets of rules without outputs
+    succeed if the whole run succeeds.
+
+    Examples:
+
+      .. code-block:: python
+
+         results = snakemake.run_targets(snakefile, ["s1.bam", "multiqc"],
+                                         options=["-d", str(samples)])
+         assert results["s1.bam"].success
+         assert results["multiqc"].outputs == [str(samples.join("multiqc.html"))]
+
+    Args:
+      snakefile (str, py._path.local.LocalPath): snakefile full path name
+      targets (list): snakemake targets to run
+
+    Kwargs:
+      See :py:func:`run`. read, iterable and async runs are not
+      supported.
+
+    Returns:
+      dict of :py:class:`TargetResult` by target
+    """
+    targets = [str(t) for t in targets]
+    streaming = [k for k in _STREAMING_OPTIONS if kwargs.get(k)]
+    if streaming:
+        raise ValueError("{} not supported for multiple targets".format(", ".join(streaming)))
+    options = list(kwargs.pop("options", []))
+    if not {"--directory", "-d"}.intersection(options):
+        options += ["-d", py.path.local(snakefile).dirname]
+    if _cores(options) is None and not jobserver.held().get("cores"):
+        options += ["-j", str(shell._threads)]
+    if not {"-k", "--keep-going"}.intersection(options):
+        options += ["--keep-going"]
+    workdir = _directory(options)
+    rules = [t for t in targets if t in _rules(snakefile, options)]
+    jobs = []
+    if rules:
+        plan_kwargs = {k: v for k, v in kwargs.items() if k not in ("save", "cache")}
+        jobs = dryrun(snakefile, target=" ".join(rules), options=options + ["--forceall"],
+                      **plan_kwargs)
+    outputs = {}
+    for t in targets:
+        paths = [o for j in jobs if j.rule == t for o in j.output] if t in rules else [t]
+        outputs[t] = [os.path.join(workdir, p) for p in paths]
+    failed = False
+    try:
+        run(snakefile, target=" ".join(targets), options=options, **kwargs)
+    except sp.CalledProcessError as e:
+        failed = True
+        logger.warning("snakemake failed for some of {}: {}".format(", ".join(targets), e))
+    # Rules without outputs (e.g. all) succeed with the whole run
+    return {t: TargetResult(all(os.path.exists(p) for p in paths) if paths else not failed, paths)
+            for t, paths in outputs.items()}
+
+
+def _conda_envs(snakefile):
+    """Return content hashes of the conda environment files used by
+    snakefile and its included files"""
+    hashes = set()
+    for f in _dependencies(snakefile, []):
+        try:
+            with open(f) as fh:
+                text = fh.read()
+        except OSError:
+            continue
+        for m in _CONDA_RE.finditer(text):
+            try:
+                with open(os.path.join(os.path.dirname(f), m.group(1)), "rb") as fh:
+                    hashes.add(hashlib.sha256(fh.read()).hexdigest())
+            except OSError:
+                logger.warning("conda environment file {} not found".format(m.group(1)))
+    return sorted(hashes)
+
+
+@contextlib.contextmanager
+def _env_locks(hashes):
+    """Hold machine-wide locks on conda environments, in sorted order"""
+    lockdir = CONDA_PREFIX / ".locks"
+    lockdir.mkdir(parents=True, exist_ok=True)
+    with contextlib.ExitStack() as stack:
+        for h in hashes:
+            fh = stack.enter_context(open(str(lockdir / "{}.lock".format(h)), "a"))
+            fcntl.flock(fh, fcntl.LOCK_EX)
+        yield lockdir
+
+
+def _create_envs(snakefile, options, **kwargs):
+    """Create the conda environments of snakefile in the shared prefix.
+
+    Creation is guarded by per-environment locks and recorded on
+    success, so that concurrent sessions and xdist workers wait for
+    each other instead of building the same environment twice. The
+    workflow itself is not locked, so that runs of other targets in
+    the same working directory can proceed.
+    """
+    hashes = _conda_envs(snakefile)
+    if not hashes:
+        return
+    lockdir = CONDA_PREFIX / ".locks"
+    if all((lockdir / "{}.done".format(h)).exists() for h in hashes):
+        return
+    with _env_locks(hashes) as lockdir:
+        if all((lockdir / "{}.done".format(h)).exists() for h in hashes):
+            return
+        run(snakefile, options=list(options) + ["--conda-create-envs-only", "--nolock"],
+            threads=None, **kwargs)
+        for h in hashes:
+            (lockdir / "{}.done".format(h)).touch()
+
+
+def create_conda_envs(snakefiles, max_workers=None, **kwargs):
+    """Create the conda environments of snakefiles in the shared prefix.
+
+    Runs snakemake --use-conda --conda-create-envs-only for every
+    snakefile concurrently. Environments are created once per machine:
+    creation of an environment is guarded by a file lock and recorded
+    on success, so concurrent sessions and xdist workers wait for each
+    other instead of creating the same environment twice.
+
+    snakemake runs with --nolock in the snakefile directory, or the
+    directory given with -d/--directory in options, so that the
+    workflow inputs resolve. Environments that cannot be resolved
+    there are created by the first :py:func:`run` that uses them,
+    under the same locks.
+
+    Examples:
+
+      .. code-block:: python
+
+         from pytest_ngsfixtures.wm import snakemake
+
+         snakemake.create_conda_envs(["/path/to/Snakefile"])
+
+    Args:
+      snakefiles (list): snakefile paths
+      max_workers (int): maximum number of concurrent snakemake runs
+
+    Kwargs:
+      See :py:func:`run`.
+
+    Returns:
+      dict mapping snakefiles to None on success, or the exception raised
+    """
+    options = ["--use-conda"] + list(kwargs.pop("options", []))
+    results = {}
+    snakefiles = sorted(set(str(f) for f in snakefiles))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(snakefiles) or 1) as executor:
+        futures = {executor.submit(_create_envs, f, options, **kwargs): f for f in snakefiles}
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[f]] = f.result()
+            except (sp.CalledProcessError, OSError) as e:
+                logger.warning("failed to create conda environments for {}: {}".format(futures[f], e))
+                results[futures[f]] = e
+    return results
@@ -14,12 +14,12 @@ with open('HISTORY.rst') as history_file:
     history = history_file.read()
 
 requirements = [
-    'pytest>=3.0.0',
+    'pytest>=3.6.0',
     'pyyaml',
 ]
 
 test_requirements = [
-    'pytest>=3.0.0',
+    'pytest>=3.6.0',
 ]
 
 extras_require = {
@@ -71,10 +71,11 @@ setup(
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
         'Topic :: Utilities',
     ],
+    python_requires='>=3.7',
     test_suite='tests',
     install_requires=requirements,
     setup_requires=['pytest-runner'],
@@ -3,10 +3,10 @@ import os
 import sys
 import py
 import pytest
-import docker
 import subprocess as sp
 from pytest_ngsfixtures import DATA_DIR
 from pytest_ngsfixtures.os import localpath
+from pytest_ngsfixtures.container import get_client, get_image, uses_images
 from pytest_ngsfixtures.config import SAMPLES_DIR
 import logging
 
@@ -52,7 +52,7 @@ def pytest_runtest_setup(item):
     dockermark = item.get_marker("docker")
     if dockermark is not None:
         try:
-            client = docker.from_env()
+            client = get_client()
             client.images.list()
         except ConnectionError:
             pytest.skip("docker executable not found; docker tests will be skipped")
@@ -66,27 +66,14 @@ def pytest_runtest_setup(item):
         get_image(SNAKEMAKE_IMAGE)
 
 
-def get_image(image):
-    try:
-        client = docker.from_env()
-        image = client.images.get(image)
-        logger.info("retrieved local image '{}'".format(image))
-    except docker.errors.ImageNotFound:
-        logger.info("docker image '{}' not found; pulling to run tests".format(image))
-        client.images.pull(image)
-        image = client.images.get(image)
-    except:
-        raise
-    return image
-
-
 def image_factory(name):
     @pytest.mark.docker
     @pytest.fixture(scope="session")
+    @uses_images(name)
     def image_fixture(request):
         def rm():
             try:
-                client = docker.from_env()
+                client = get_client()
                 containers = client.containers.list(filters={'status': 'exited',
                                                              'ancestor': name})
                 for c in containers:
@@ -100,12 +87,7 @@ def image_factory(name):
                 pass
 
         request.addfinalizer(rm)
-        client = docker.from_env()
-        try:
-            image = client.images.get(name)
-        except:
-            raise
-        return image
+        return get_image(name)
     return image_fixture
 
 
@@ -116,6 +98,7 @@ snakemake_image = image_factory(SNAKEMAKE_IMAGE)
 def container_factory(name):
     @pytest.mark.docker
     @pytest.fixture(scope="session")
+    @uses_images(name)
     def container_fixture(request):
         def rm():
             try:
@@ -127,11 +110,8 @@ def container_factory(name):
                 pass
 
         request.addfinalizer(rm)
-        client = docker.from_env()
-        try:
-            image = client.images.get(name)
-        except:
-            raise
+        client = get_client()
+        image = get_image(name)
         container = client.containers.create(image, tty=True,
                                              user="{}:{}".format(pytest.uid, pytest.gid),
                                              volumes={'/tmp': {'bind': '/tmp', 'mode': 'rw'}},
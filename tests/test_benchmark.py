@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+test_benchmark
+----------------------------------
+
+Benchmarks for `pytest_ngsfixtures.shell` module. Requires
+pytest-benchmark.
+"""
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from pytest_ngsfixtures.shell import shell, iter_lines, CHUNK_SIZE  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def chunks():
+    line = b"r1\t0\tscaffold1\t1\t60\t100M\t*\t0\t0\t" + b"ACGT" * 25 + b"\n"
+    data = line * (2**24 // len(line))
+    return [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+
+
+@pytest.mark.parametrize("encoding", ["utf-8", None])
+def test_iter_lines_throughput(benchmark, chunks, encoding):
+    n = benchmark(lambda: sum(1 for _ in iter_lines(chunks, encoding)))
+    assert n == sum(c.count(b"\n") for c in chunks)
+
+
+def test_shell_iterable_throughput(benchmark):
+    n = benchmark(lambda: sum(1 for _ in shell("seq 1 1000000", iterable=True)))
+    assert n == 1000000
+
+
+@pytest.mark.parametrize("persistent", [False, True], ids=["spawn", "persistent"])
+def test_shell_small_commands(benchmark, persistent):
+    benchmark(lambda: shell("wc -c < /dev/null", persistent=persistent, read=True))
+
+
+@pytest.mark.parametrize("rss_mb", [0, 256, 1024])
+@pytest.mark.parametrize("spawn", [True, False], ids=["posix_spawn", "fork"])
+def test_shell_spawn_latency(benchmark, rss_mb, spawn):
+    # Touch every page so that the parent's resident set actually grows
+    ballast = b"\x01" * (rss_mb * 2**20)  # noqa: F841
+    shell.spawn(spawn)
+    try:
+        benchmark(lambda: shell("true"))
+    finally:
+        shell.spawn(True)
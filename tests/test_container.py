@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+test_container
+----------------------------------
+
+Tests for `pytest_ngsfixtures.container` module.
+"""
+import os
+import time
+import pytest
+import multiprocessing as mp
+from pytest_ngsfixtures import container
+
+
+class FakeContainer:
+    def __init__(self, image, **kwargs):
+        self.image = image
+        self.kwargs = kwargs
+        self.name = self.short_id = "fake{}".format(id(self))
+        self.status = "running"
+        self.removed = False
+
+    def reload(self):
+        pass
+
+    def remove(self, force=False):
+        self.removed = True
+
+
+class FakeContainers:
+    def __init__(self):
+        self.started = []
+
+    def run(self, image, **kwargs):
+        c = FakeContainer(image, **kwargs)
+        self.started.append(c)
+        return c
+
+
+class FakeImage:
+    def __init__(self, name):
+        self.id = name
+        self.tags = [name]
+
+    def tag(self, repository, tag):
+        self.tags.append("{}:{}".format(repository, tag))
+
+
+class FakeImages:
+    def __init__(self):
+        self.local = {}
+        self.lookups = 0
+        self.pulled = []
+
+    def get(self, name):
+        self.lookups += 1
+        if name not in self.local:
+            raise container.docker.errors.ImageNotFound(name)
+        return self.local[name]
+
+    def pull(self, repository, tag=None):
+        name = "{}:{}".format(repository, tag)
+        self.pulled.append(name)
+        if repository.endswith("missing"):
+            raise container.docker.errors.NotFound(name)
+        return FakeImage(name)
+
+
+class FakeClient:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.healthy = True
+        self.closed = False
+        self.containers = FakeContainers()
+        self.images = FakeImages()
+
+    def ping(self):
+        return self.healthy
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    monkeypatch.setattr(container.docker, "from_env", FakeClient)
+    monkeypatch.setattr(container, "_images", {})
+    container.reset()
+    yield
+    container.reset()
+
+
+def _client_in_child(queue):
+    queue.put((id(container.get_client()), container._client_pid == os.getpid()))
+
+
+def test_get_client_reused(fake_client):
+    client = container.get_client()
+    assert client is container.get_client()
+    assert client.kwargs["max_pool_size"] == container.MAX_POOL_SIZE
+
+
+def test_get_client_health_check(fake_client):
+    client = container.get_client()
+    client.healthy = False
+    assert container.get_client() is client
+    new = container.get_client(health_interval=0)
+    assert new is not client
+    assert client.closed
+
+
+def test_get_client_fork(fake_client):
+    client = container.get_client()
+    queue = mp.get_context("fork").Queue()
+    p = mp.get_context("fork").Process(target=_client_in_child, args=(queue,))
+    p.start()
+    child_id, owned = queue.get(timeout=10)
+    p.join()
+    assert owned
+    assert child_id != id(client)
+    assert not client.closed
+
+
+def test_container_pool(fake_client):
+    pool = container.ContainerPool(size=1)
+    with pool.lease("busybox", user="1000:1000") as c:
+        assert c.kwargs["user"] == "1000:1000"
+        assert c.kwargs["entrypoint"] == ["/bin/sh"]
+    # Idle container is reused for the same key only
+    with pool.lease("busybox", user="1000:1000") as d:
+        assert d is c
+        with pool.lease("busybox", user="1000:1000") as e:
+            assert e is not c
+    with pool.lease("busybox", user="0:0") as f:
+        assert f is not c
+    # Pool size caps the number of idle containers per key
+    assert c.removed and not e.removed
+    # Containers that stopped are replaced
+    e.status = "exited"
+    with pool.lease("busybox", user="1000:1000") as g:
+        assert g is not e
+    assert e.removed
+    pool.close()
+    assert g.removed and f.removed
+
+
+def test_container_pool_evict(fake_client):
+    pool = container.ContainerPool(idle_timeout=0.1)
+    with pool.lease("busybox") as c:
+        pass
+    pool.evict()
+    assert not c.removed
+    time.sleep(0.2)
+    pool.evict()
+    assert c.removed
+
+
+def test_get_image_cached(fake_client):
+    client = container.get_client()
+    client.images.local["busybox:latest"] = FakeImage("busybox:latest")
+    image = container.get_image("busybox:latest")
+    assert container.get_image("busybox:latest") is image
+    assert client.images.lookups == 1
+    container.get_image("alpine")
+    assert client.images.pulled == ["alpine:latest"]
+
+
+def test_pull_images_registry(fake_client):
+    client = container.get_client()
+    images = container.pull_images(["alpine:3.7", "quay.io/biocontainers/samtools:1.6",
+                                    "missing:1"], registry="localhost:5000")
+    assert sorted(client.images.pulled) == ["localhost:5000/alpine:3.7",
+                                            "localhost:5000/biocontainers/samtools:1.6",
+                                            "localhost:5000/missing:1"]
+    assert "alpine:3.7" in images["alpine:3.7"].tags
+    assert isinstance(images["missing:1"], container.docker.errors.NotFound)
+    # Resolved images are not pulled again
+    assert container.pull_images(["alpine:3.7"]) == {}
+
+
+def test_bind_mounts(tmpdir):
+    data = tmpdir.mkdir("data")
+    samples = tmpdir.mkdir("samples")
+    nested = samples.mkdir("nested")
+    snakefile = tmpdir.mkdir("wf").join("Snakefile")
+    snakefile.write("")
+    volumes = container.bind_mounts([samples, nested, snakefile, data.join("ref.fa")],
+                                    data_dir=data)
+    assert volumes == {
+        str(data): {'bind': str(data), 'mode': "ro"},
+        str(samples): {'bind': str(samples), 'mode': "rw"},
+        str(snakefile.dirpath()): {'bind': str(snakefile.dirpath()), 'mode': "rw"},
+    }
+    volumes = container.bind_mounts([nested, samples], mode="ro", data_dir=data)
+    assert list(volumes) == [str(data), str(samples)]
+    assert volumes[str(samples)]['mode'] == "ro"
+    assert container.bind_mounts([tmpdir], data_dir=data) == {
+        str(tmpdir): {'bind': str(tmpdir), 'mode': "rw"}}
+
+
+def test_container_pool_close_leased(fake_client):
+    pool = container.ContainerPool()
+    c = pool.acquire("busybox")
+    pool.close()
+    assert c.removed
+    c.removed = False
+    # Releasing after close does not return the container to the pool
+    pool.release(c, "busybox")
+    assert not c.removed and not pool._idle
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+test_jobserver
+----------------------------------
+
+Tests for `pytest_ngsfixtures.jobserver` module.
+"""
+import json
+import time
+import threading
+import contextvars
+import concurrent.futures
+import multiprocessing as mp
+from pytest_ngsfixtures.jobserver import JobServer, pack
+
+
+def _hold(path, seconds):
+    js = JobServer({'cores': 2}, path=path)
+    with js.reserve(cores=2):
+        time.sleep(seconds)
+
+
+def test_jobserver_reserve(tmpdir):
+    js = JobServer({'cores': 4}, path=str(tmpdir.join("js")))
+    with js.reserve(cores=2) as waited:
+        assert waited == 0.0
+    assert js.queue_time() == 0.0
+
+
+def test_jobserver_nested(tmpdir):
+    js = JobServer({'cores': 2}, path=str(tmpdir.join("js")))
+    with js.reserve(cores=2):
+        # Covered by the outer reservation; must not block
+        token = js.acquire(cores=1)
+        assert js.held() == {'cores': 1}
+        js.release(token)
+        assert js.held() == {'cores': 2}
+        assert js.acquire(cores=0) is None
+
+
+def test_jobserver_clamp(tmpdir):
+    js = JobServer({'cores': 2}, path=str(tmpdir.join("js")))
+    token = js.acquire(cores=8)
+    assert token is not None
+    js.release(token)
+
+
+def test_jobserver_waits_for_other_process(tmpdir):
+    path = str(tmpdir.join("js"))
+    p = mp.Process(target=_hold, args=(path, 1.0))
+    p.start()
+    time.sleep(0.3)
+    js = JobServer({'cores': 2}, path=path, poll=0.05)
+    with js.reserve(cores=1) as waited:
+        assert waited > 0.2
+    p.join()
+    assert js.queue_time(reset=True) > 0.2
+    assert js.queue_time() == 0.0
+
+
+def test_jobserver_reclaims_dead_process(tmpdir):
+    path = str(tmpdir.join("js"))
+    p = mp.Process(target=JobServer({'cores': 1}, path=path).acquire, kwargs={'cores': 1})
+    p.start()
+    p.join()
+    js = JobServer({'cores': 1}, path=path, poll=0.05)
+    with js.reserve(cores=1) as waited:
+        assert waited == 0.0
+
+
+def test_jobserver_pack():
+    budget = {'cores': 4, 'mem_mb': 1000}
+    requests = [{'cores': 4, 'mem_mb': 100},
+                {'cores': 4, 'mem_mb': 100},
+                {'cores': 1, 'mem_mb': 900},
+                {'cores': 3, 'mem_mb': 100}]
+    order = pack(requests, budget)
+    assert sorted(order) == [0, 1, 2, 3]
+    # Light core request packed with the complementing core request
+    assert order.index(3) == order.index(2) + 1 or order.index(2) == order.index(3) + 1
+
+
+def test_jobserver_disjoint_cpus(tmpdir):
+    path = str(tmpdir.join("js"))
+    a = JobServer({'cores': 4}, path=path)
+    b = JobServer({'cores': 4}, path=path)
+    # Independent of the number of CPUs on the test machine
+    a._cpus = b._cpus = [0, 1, 2, 3]
+    ta = a.acquire(cores=2)
+    tb = b.acquire(cores=2)
+    cpus_a, cpus_b = a.allocation(ta)['cpus'], b.allocation(tb)['cpus']
+    assert len(cpus_a) == len(cpus_b) == 2
+    assert not set(cpus_a) & set(cpus_b)
+    assert a.allocation()['resources'] == {'cores': 2}
+    a.release(ta)
+    assert a.allocation() == {'resources': {}, 'cpus': []}
+    b.release(tb)
+
+
+def test_jobserver_threads_do_not_share(tmpdir):
+    js = JobServer({'cores': 4}, path=str(tmpdir.join("js")), poll=0.01)
+    lock = threading.Lock()
+    active, peak = [0], [0]
+
+    def _reserve():
+        with js.reserve(cores=4):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda i: _reserve(), range(4)))
+    assert peak[0] == 1
+
+
+def test_jobserver_nested_shortfall(tmpdir):
+    js = JobServer({'cores': 8}, path=str(tmpdir.join("js")))
+    with js.reserve(cores=4):
+        token = js.acquire(cores=8)
+        assert js.allocation(token)['resources'] == {'cores': 8}
+        assert js.held() == {'cores': 8}
+        # Only the shortfall is drawn from the pool
+        with open(js.path) as fh:
+            assert [h['resources'] for h in json.load(fh).values()] == [{'cores': 4}, {'cores': 4}]
+        js.release(token)
+        assert js.held() == {'cores': 4}
+        # Copied contexts nest in the reservation
+        ctx = contextvars.copy_context()
+        token = ctx.run(js.acquire, cores=2)
+        assert js.held() == {'cores': 2}
+        js.release(token)
+        assert js.held() == {'cores': 4}
+    assert js.held() == {}
+
+
+def test_jobserver_siblings_share_reservation(tmpdir):
+    js = JobServer({'cores': 4}, path=str(tmpdir.join("js")), poll=0.01)
+    js._cpus = [0, 1, 2, 3]
+    lock = threading.Lock()
+    active, peak, cpus = [0], [0], []
+
+    def _reserve():
+        with js.reserve(cores=2):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+                cpus.append(js.allocation()['cpus'])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+    with js.reserve(cores=4):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, _reserve)
+                       for i in range(4)]
+            for f in futures:
+                f.result()
+        assert js.held() == {'cores': 4}
+    # Two siblings at a time fit in the parent reservation, on its CPUs
+    assert peak[0] == 2
+    assert all(len(c) == 2 for c in cpus)
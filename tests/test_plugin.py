@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import sys
+import subprocess
 import pytest
 from pytest_ngsfixtures.plugin import Fixture
 
@@ -27,3 +29,122 @@ def test_fixture_testdata_testunit_class():
 def test_fixture_testdata_path_class(tmpdir_factory):
     p = Fixture(dirname="foo", path=tmpdir_factory.getbasetemp().join("bar"))
     assert str(p).endswith("bar")
+
+
+def test_ngs_resources_packing(testdir):
+    testdir.makepyfile("""
+        import pytest
+
+        @pytest.mark.ngs_resources(threads=1)
+        def test_a():
+            pass
+
+        @pytest.mark.ngs_resources(threads=3)
+        def test_b():
+            pass
+
+        @pytest.mark.ngs_resources(threads=1)
+        def test_c():
+            pass
+
+        def test_d():
+            pass
+
+        @pytest.mark.ngs_resources(threads=3)
+        def test_e():
+            pass
+    """)
+    result = testdir.runpytest("-v", "--ngs-cores=4")
+    result.assert_outcomes(passed=5)
+    # Bins [b, a] and [e, c] fill the marked positions; d stays put
+    result.stdout.fnmatch_lines(["*test_b*", "*test_a*", "*test_e*", "*test_d*", "*test_c*"])
+
+
+def test_ngs_user_properties(testdir):
+    testdir.makepyfile("""
+        from pytest_ngsfixtures.shell import shell
+
+        def test_plain():
+            pass
+
+        def test_shell():
+            shell("true")
+    """)
+    result = testdir.runpytest("--junitxml=report.xml")
+    result.assert_outcomes(passed=2)
+    report = testdir.tmpdir.join("report.xml").read()
+    # Only tests that ran commands get ngs properties
+    assert report.count('name="ngs_usage"') == 1
+    assert "ngs_queue_time" not in report and "ngs_rule_metrics" not in report
+
+
+def test_ngs_image_prepull(testdir):
+    testdir.makeconftest("""
+        import pytest
+        from pytest_ngsfixtures import container
+
+        pulled = []
+        pull_images = container.pull_images
+
+        def pytest_configure(config):
+            container.pull_images = lambda names, **kwargs: pulled.append(sorted(names))
+
+        def pytest_unconfigure(config):
+            container.pull_images = pull_images
+
+        @pytest.fixture
+        @container.uses_images("alpine:3.7")
+        def alpine():
+            return "alpine:3.7"
+
+        @pytest.fixture
+        def pulled_images():
+            return pulled
+    """)
+    testdir.makepyfile("""
+        import pytest
+
+        @pytest.mark.ngs_image("busybox:latest")
+        def test_a(pulled_images):
+            assert pulled_images == [["alpine:3.7", "busybox:latest"]]
+
+        def test_b(alpine, pulled_images):
+            assert len(pulled_images) == 1
+    """)
+    result = testdir.runpytest("-v")
+    result.assert_outcomes(passed=2)
+
+
+def test_ngs_perf(testdir):
+    testdir.makepyfile("""
+        import pytest
+        from pytest_ngsfixtures.wm import benchmark
+
+        @pytest.fixture
+        def align_metrics():
+            benchmark._record({'align': {'jobs': 1, 's': 12.0, 'max_rss': 1500.0}})
+
+        @pytest.mark.ngs_perf(rule="align", max_s=30, max_rss_mb=2000)
+        def test_fast(align_metrics):
+            pass
+
+        @pytest.mark.ngs_perf("align", max_rss_mb=1000)
+        def test_rss(align_metrics):
+            pass
+
+        @pytest.mark.ngs_perf(rule="sort", max_s=1)
+        def test_missing(align_metrics):
+            pass
+    """)
+    result = testdir.runpytest("-v")
+    result.assert_outcomes(passed=1, failed=2)
+    result.stdout.fnmatch_lines(["*rule 'align' used 1500MB > 1000MB*",
+                                 "*no metrics recorded for rule 'sort'*"])
+
+
+def test_plugin_without_docker():
+    # The plugin is loaded by every pytest run and must not require docker
+    code = ("import sys; sys.modules['docker'] = None; "
+            "from pytest_ngsfixtures import plugin; "
+            "assert plugin._optional('shell') is None and plugin._usage() == []")
+    subprocess.check_call([sys.executable, "-c", code])
@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import pytest
+import os
+import time
 import types
+import shutil
+import asyncio
+import pathlib
 import subprocess as sp
-from pytest_ngsfixtures.shell import shell
+import pytest_ngsfixtures.shell as shell_module
+from pytest_ngsfixtures import jobserver
+from pytest_ngsfixtures.shell import shell, get_conda_root, iter_lines, usage, Capture, OutputLimitExceeded, ShellSession
+import docker
 from docker.models.containers import Container
 
 
@@ -170,3 +178,515 @@ def test_container_shell_path(busybox_container, foo, shell_config):
           path_list=["/foo", "/bar"],
           container=busybox_container)
     assert touch.readlines()[0].startswith("/foo:/bar")
+
+
+def test_shell_run_async(foo):
+    async def main():
+        touch = foo.join("test_shell_run_async.touch")
+        ret = await shell.run_async("touch " + str(touch))
+        assert ret is None
+        assert touch.exists()
+        out = await asyncio.gather(*[shell.run_async("echo {}".format(i), read=True)
+                                     for i in range(5)])
+        assert [x.rstrip() for x in out] == [str(i) for i in range(5)]
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_shell_run_async_iterable(foo):
+    async def main():
+        proc = await shell.run_async("ls " + str(foo), iterable=True,
+                                     stderr=asyncio.subprocess.PIPE)
+        lines = []
+        async for line in proc:
+            lines.append(line)
+        await proc.wait()
+        return lines
+    assert "bar.txt" in asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_shell_run_async_long_line():
+    async def main():
+        proc = await shell.run_async("head -c 200000 /dev/zero | tr '\\0' x; echo; echo foo",
+                                     iterable=True)
+        lines = [line async for line in proc]
+        await proc.wait()
+        return lines
+    assert asyncio.get_event_loop().run_until_complete(main()) == ["x" * 200000, "foo"]
+
+
+def test_shell_run_async_error():
+    async def main():
+        await shell.run_async("exit 3")
+    with pytest.raises(sp.CalledProcessError):
+        asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_shell_run_async_cancel():
+    async def main():
+        proc = await shell.run_async("sleep 30", iterable=True)
+        task = asyncio.ensure_future(proc.wait())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return proc
+    proc = asyncio.get_event_loop().run_until_complete(main())
+    assert proc.returncode is not None
+
+
+def test_shell_run_async_cancel_group(tmpdir):
+    pidfile = tmpdir.join("pid")
+
+    async def main():
+        proc = await shell.run_async("sleep 30 & echo $! > {}; wait".format(pidfile), iterable=True)
+        while not pidfile.exists() or not pidfile.read().strip():
+            await asyncio.sleep(0.05)
+        await proc.cancel(grace=1)
+    asyncio.get_event_loop().run_until_complete(main())
+    pid = int(pidfile.read())
+    time.sleep(0.1)
+    # The background job was killed along with the shell
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+
+
+def test_shell_map(foo):
+    cmds = ["echo {}".format(i) for i in range(8)]
+    results = shell.map(cmds, max_workers=4)
+    assert [r.cmd for r in results] == cmds
+    assert [r.stdout.rstrip() for r in results] == [str(i) for i in range(8)]
+    assert all(r.returncode == 0 and r.elapsed >= 0 for r in results)
+
+
+def test_shell_map_nested_reservation(tmpdir, monkeypatch):
+    js = jobserver.JobServer({'cores': 4}, path=str(tmpdir.join("js")), poll=0.01)
+    monkeypatch.setattr(jobserver, "_jobserver", js)
+    cmds = ["sleep 0.3"] * 4
+    with js.reserve(cores=4):
+        start = time.time()
+        shell.map(cmds, threads=4, max_workers=4)
+        # The commands share the enclosing reservation
+        assert time.time() - start >= 1.2
+        start = time.time()
+        shell.map(cmds, threads=1, max_workers=4)
+        assert time.time() - start < 1.2
+
+
+def test_shell_map_fail_fast():
+    with pytest.raises(sp.CalledProcessError):
+        shell.map(["exit 1", "sleep 0.2", "sleep 0.2"], max_workers=1)
+
+
+def test_shell_map_keep_going():
+    results = shell.map(["echo foo >&2; exit 2", "echo bar"], fail_fast=False)
+    assert results[0].returncode == 2
+    assert results[0].stderr.rstrip() == "foo"
+    assert results[1].stdout.rstrip() == "bar"
+
+
+def test_shell_map_timeout():
+    start = time.time()
+    with pytest.raises(sp.TimeoutExpired):
+        shell.map(["sleep 5"], timeout=0.5, grace=0.5)
+    results = shell.map(["sleep 5", "echo foo"], timeout=0.5, grace=0.5, fail_fast=False)
+    assert [r.returncode for r in results] == [124, 0]
+    assert time.time() - start < 4
+
+
+def test_shell_map_unsupported_option():
+    with pytest.raises(TypeError):
+        shell.map(["echo foo"], user="root")
+
+
+@pytest.mark.docker
+@pytest.mark.busybox
+def test_container_shell_map(busybox_container, foo, shell_config):
+    busybox_container.start()
+    results = shell.map(["ls " + str(foo), "exit 1"], container=busybox_container,
+                        fail_fast=False)
+    assert "bar.txt" in results[0].stdout
+    assert results[1].returncode == 1
+
+
+def test_iter_lines_chunk_boundaries():
+    data = "foo\nbär\nbaz".encode()
+    # Split inside the multi-byte character and at the line breaks
+    chunks = [data[i:i + 1] for i in range(len(data))]
+    assert list(iter_lines(chunks)) == ["foo", "bär", "baz"]
+    assert list(iter_lines([data[:5], data[5:]])) == ["foo", "bär", "baz"]
+    assert list(iter_lines(chunks, encoding=None)) == [b"foo", "bär".encode(), b"baz"]
+    assert list(iter_lines([b"foo\n\nbar\n"])) == ["foo", "", "bar"]
+    assert list(iter_lines([])) == []
+
+
+def test_shell_iterable_bytes(foo):
+    ret = shell("ls " + str(foo), iterable=True, encoding=None)
+    assert b"bar.txt" in list(ret)
+
+
+def test_shell_iterable_error():
+    with pytest.raises(sp.CalledProcessError):
+        list(shell("echo foo; exit 1", iterable=True))
+
+
+def test_shell_capture(tmpdir):
+    ret = shell("seq 1 100000; echo foo >&2", capture=tmpdir)
+    assert isinstance(ret, Capture)
+    assert ret.returncode == 0
+    assert ret.text().startswith("1\n2\n")
+    assert sum(1 for _ in ret.lines()) == 100000
+    assert ret.mmap()[:4] == b"1\n2\n"
+    assert ret.text("stderr") == "foo\n"
+    assert ret.tail(2, stream="stdout") == "0\n"
+
+
+def test_shell_capture_error(tmpdir):
+    with pytest.raises(sp.CalledProcessError) as e:
+        shell("echo foo >&2; exit 1", capture=tmpdir)
+    assert e.value.stderr == "foo\n"
+
+
+def test_shell_capture_max_bytes(tmpdir):
+    with pytest.raises(OutputLimitExceeded):
+        shell("yes", capture=tmpdir, max_bytes=2**20)
+
+
+def test_shell_capture_max_bytes_pipeline(tmpdir):
+    with pytest.raises(OutputLimitExceeded):
+        shell("yes | cat", capture=tmpdir, max_bytes=2**20)
+    stdout, = tmpdir.listdir("*.stdout")
+    size = stdout.size()
+    time.sleep(0.5)
+    assert stdout.size() == size
+
+
+def test_shell_capture_max_bytes_bounded(tmpdir):
+    with pytest.raises(OutputLimitExceeded) as e:
+        shell("echo foo >&2; head -c 200000000 /dev/zero; echo bar >&2",
+              capture=tmpdir, max_bytes=2**20)
+    # Nothing beyond the limit reaches the disk
+    stdout, = tmpdir.listdir("*.stdout")
+    assert stdout.size() == 2**20
+    assert e.value.stderr.startswith("foo")
+    with pytest.raises(ValueError):
+        shell("true", max_bytes=2**20)
+
+
+def test_shell_usage():
+    usage(reset=True)
+    shell("python -c 'x = bytearray(50 * 2**20)'")
+    list(shell("echo foo", iterable=True))
+    recorded = usage(reset=True)
+    assert len(recorded) == 2
+    assert recorded[0].maxrss_mb > 40
+    assert recorded[0].elapsed >= recorded[0].utime >= 0
+    assert usage() == []
+
+
+def test_shell_timeout(tmpdir):
+    pidfile = tmpdir.join("grandchild.pid")
+    start = time.time()
+    with pytest.raises(sp.TimeoutExpired):
+        shell("sleep 30 & echo $! > {}; wait".format(pidfile), timeout=0.5, grace=0.5)
+    assert time.time() - start < 5
+    # The backgrounded grandchild is killed along with the group
+    pid = int(pidfile.read())
+    with pytest.raises(ProcessLookupError):
+        # Allow for the orphaned grandchild to be reaped
+        for _ in range(50):
+            os.kill(pid, 0)
+            time.sleep(0.1)
+
+
+def test_shell_timeout_iterable():
+    with pytest.raises(sp.TimeoutExpired):
+        list(shell("echo foo; sleep 30", iterable=True, timeout=0.5))
+
+
+def test_shell_timeout_poll():
+    usage(reset=True)
+    proc = shell("true", async_=True, timeout=0.5)
+    while proc.poll() is None:
+        time.sleep(0.01)
+    time.sleep(0.7)
+    assert not proc.timed_out
+    assert len(usage(reset=True)) == 1
+
+
+def test_shell_timeout_not_expired():
+    assert shell("echo foo", read=True, timeout=10).rstrip() == "foo"
+
+
+@pytest.fixture
+def conda_cache(monkeypatch, tmpdir):
+    monkeypatch.setattr(shell_module, "_conda_root", None)
+    monkeypatch.setattr(shell_module, "CACHE_DIR", pathlib.Path(str(tmpdir)))
+    monkeypatch.delenv("CONDA_EXE", raising=False)
+    monkeypatch.delenv("CONDA_PREFIX", raising=False)
+    return tmpdir
+
+
+@pytest.mark.skipif(shutil.which("conda") is None, reason="executable conda not found")
+def test_get_conda_root_cached(conda_cache, monkeypatch):
+    root = get_conda_root()
+    assert conda_cache.join("conda_root.json").exists()
+    # Neither the session nor the persistent cache calls conda again
+    monkeypatch.setattr(shell_module, "_conda_root_from_info", None)
+    assert get_conda_root() == root
+    monkeypatch.setattr(shell_module, "_conda_root", None)
+    assert get_conda_root() == root
+
+
+@pytest.mark.skipif(shutil.which("conda") is None, reason="executable conda not found")
+def test_get_conda_root_env(conda_cache, monkeypatch):
+    root = os.path.dirname(os.path.dirname(os.path.realpath(shutil.which("conda"))))
+    monkeypatch.setenv("CONDA_EXE", os.path.join(root, "bin", "conda"))
+    monkeypatch.setattr(shell_module, "_conda_root_from_info", None)
+    assert get_conda_root() == root
+    assert not conda_cache.join("conda_root.json").exists()
+
+
+@pytest.mark.skipif(shutil.which("conda") is None, reason="executable conda not found")
+def test_shell_conda_env_cached(monkeypatch):
+    monkeypatch.setattr(shell_module, "_activated", {})
+    ret = shell("echo $CONDA_DEFAULT_ENV", conda_env="base", read=True)
+    assert ret.rstrip() == "base"
+    assert len(shell_module._activated) == 1
+    (prefix, (stamp, (changed, unset, path))), = shell_module._activated.items()
+    # Cached activation is applied without running activate again
+    changed["NGS_TEST_ACTIVATED"] = "1"
+    assert shell("echo $NGS_TEST_ACTIVATED", conda_env="base", read=True).rstrip() == "1"
+    # A changed conda-meta invalidates the cache
+    shell_module._activated[prefix] = ([0], (changed, unset, path))
+    assert shell("echo ${NGS_TEST_ACTIVATED:-}", conda_env="base", read=True).rstrip() == ""
+
+
+def test_shell_conda_env_overlay(monkeypatch, tmpdir):
+    monkeypatch.setattr(shell_module, "_activated", {})
+    prefix = tmpdir.mkdir("env")
+    prefix.mkdir("conda-meta")
+    bindir = tmpdir.mkdir("bin")
+    bindir.join("activate").write("export NGS_TEST_ACTIVATED=1\nunset NGS_TEST_UNSET\n"
+                                  "export PATH={}/bin:$PATH\n".format(prefix))
+    monkeypatch.setenv("PATH", "{}:{}".format(bindir, os.environ["PATH"]))
+    monkeypatch.setenv("NGS_TEST_UNSET", "1")
+    environ = shell._environ(str(prefix))
+    assert environ["NGS_TEST_ACTIVATED"] == "1"
+    assert "NGS_TEST_UNSET" not in environ
+    assert environ["PATH"] == "{}/bin:{}".format(prefix, os.environ["PATH"])
+    # Later changes to the process environment are honoured
+    monkeypatch.setenv("NGS_TEST_LATER", "1")
+    monkeypatch.setenv("PATH", "/ngs/later:{}".format(os.environ["PATH"]))
+    assert shell("echo $NGS_TEST_ACTIVATED$NGS_TEST_LATER", conda_env=str(prefix),
+                 read=True).rstrip() == "11"
+    assert shell._environ(str(prefix))["PATH"] == "{}/bin:{}".format(prefix, os.environ["PATH"])
+    assert len(shell_module._activated) == 1
+
+
+def test_shell_conda_env_failure_cached(monkeypatch, tmpdir):
+    monkeypatch.setattr(shell_module, "_activated", {})
+    prefix = tmpdir.mkdir("env")
+    prefix.mkdir("conda-meta")
+    bindir = tmpdir.mkdir("bin")
+    calls = tmpdir.join("calls")
+    bindir.join("activate").write("echo >> {}\nfalse\n".format(calls))
+    monkeypatch.setenv("PATH", "{}:{}".format(bindir, os.environ["PATH"]))
+    assert shell._environ(str(prefix)) is None
+    assert shell._environ(str(prefix)) is None
+    # Activation is not attempted again for an unchanged environment
+    assert len(calls.readlines()) == 1
+
+
+def test_shell_argv(foo, tmpdir):
+    assert shell(["echo", "foo bar", "$HOME"], read=True) == "foo bar $HOME\n"
+    assert "bar.txt" in list(shell(["ls", str(foo)], iterable=True))
+    # PATH is honoured through the process environment
+    bindir = tmpdir.mkdir("bin")
+    exe = bindir.join("ngs-argv-test")
+    exe.write("#!/bin/sh\necho argv\n")
+    exe.chmod(0o755)
+    assert shell(["ngs-argv-test"], path_list=[str(bindir)], read=True) == "argv\n"
+    with pytest.raises(sp.CalledProcessError):
+        shell(["false"])
+
+
+def test_shell_persistent(foo):
+    with ShellSession() as session:
+        assert session("echo foo; echo bar >&2", read=True) == "foo\n"
+        pid = session.pid
+        assert session("printf foo", read=True) == "foo"
+        assert "bar.txt" in list(session("ls " + str(foo), iterable=True))
+        # Commands run in a subshell; exit does not kill the session
+        with pytest.raises(sp.CalledProcessError) as e:
+            session("echo err >&2; exit 3")
+        assert e.value.returncode == 3
+        assert e.value.stderr == b"err\n"
+        session("cd /")
+        assert session("pwd", read=True) != "/\n"
+        assert session.pid == pid
+        # Timeouts kill the session, which is respawned on next use
+        with pytest.raises(sp.TimeoutExpired):
+            session("sleep 30", timeout=0.5)
+        assert session("echo foo", read=True) == "foo\n"
+        assert session.pid != pid
+    assert shell("echo foo", persistent=True, read=True) == "foo\n"
+
+
+@pytest.mark.skipif(not hasattr(os, "posix_spawn"), reason="os.posix_spawn not available")
+def test_shell_posix_spawn(tmpdir, monkeypatch):
+    calls = []
+    posix_spawn = os.posix_spawn
+
+    def spy(*args, **kwargs):
+        calls.append(kwargs)
+        return posix_spawn(*args, **kwargs)
+    monkeypatch.setattr(os, "posix_spawn", spy)
+    out = tmpdir.join("out.txt")
+    with open(str(out), "w") as fh:
+        shell("echo out; echo err >&2", stdout=fh, stderr=sp.STDOUT)
+    assert out.read() == "out\nerr\n"
+    assert shell(["echo", "foo"], read=True) == "foo\n"
+    with pytest.raises(sp.TimeoutExpired):
+        shell("sleep 30", timeout=0.5)
+    assert len(calls) == 3
+    assert calls[-1]["setsid"]
+    # Options posix_spawn cannot honour fall back to fork/exec
+    proc = shell_module._Popen(["pwd"], cwd=str(tmpdir), stdout=sp.PIPE)
+    assert proc.communicate()[0].decode() == str(tmpdir) + "\n"
+    assert len(calls) == 3
+    shell.spawn(False)
+    try:
+        shell("true")
+    finally:
+        shell.spawn(True)
+    assert len(calls) == 3
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="/proc not available")
+def test_shell_posix_spawn_close_fds(monkeypatch):
+    calls = []
+    posix_spawn = os.posix_spawn
+
+    def spy(*args, **kwargs):
+        calls.append(kwargs)
+        return posix_spawn(*args, **kwargs)
+    monkeypatch.setattr(os, "posix_spawn", spy)
+    r, w = os.pipe()
+    os.set_inheritable(w, True)
+    try:
+        cmd = "test -e /proc/self/fd/{} && echo leaked || echo closed".format(w)
+        # Inheritable descriptors are closed by default, also when spawning
+        assert shell(cmd, read=True) == "closed\n"
+        assert len(calls) == 1
+        assert shell_module._Popen(cmd, shell=True, close_fds=False,
+                                   stdout=sp.PIPE).communicate()[0] == b"leaked\n"
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+@pytest.mark.docker
+@pytest.mark.busybox
+def test_busybox_image_shell_pool(busybox_image, foo, image_args, shell_config):
+    for _ in range(2):
+        ret = shell("ls", read=True, image=busybox_image, pool=True,
+                    working_dir=str(foo), **image_args)
+        assert "foo.txt" in ret
+    assert "bar.txt" in list(shell("ls " + str(foo), iterable=True, pool=True,
+                                   image=busybox_image, **image_args))
+    with pytest.raises(docker.errors.ContainerError):
+        shell("false", image=busybox_image, pool=True, **image_args)
+
+
+class FakeExecApi:
+    def __init__(self, frames, exit_code, lag=0):
+        self.frames = frames
+        self.exit_code = exit_code
+        self.consumed = 0
+        # Number of inspections reporting the exec as running after
+        # its output has ended
+        self.lag = lag
+
+    def exec_create(self, container, cmd, **kwargs):
+        return {'Id': "exec"}
+
+    def exec_start(self, exec_id, stream=False, demux=False):
+        assert stream and demux
+        for frame in self.frames:
+            self.consumed += 1
+            yield frame
+
+    def exec_inspect(self, exec_id):
+        running = self.consumed < len(self.frames)
+        if not running and self.lag:
+            self.lag -= 1
+            running = True
+        return {'Running': running, 'ExitCode': None if running else self.exit_code}
+
+
+def fake_container(frames, exit_code=0, lag=0):
+    c = types.SimpleNamespace(id="fake", short_id="fake", limits={}, client=types.SimpleNamespace(
+        api=FakeExecApi(frames, exit_code, lag=lag)))
+    c.update = c.limits.update
+    return c
+
+
+def test_container_cpu_one_shot(monkeypatch):
+    calls = []
+
+    class Stats:
+        def stats(self, **kwargs):
+            calls.append(kwargs)
+            return {'cpu_stats': {'cpu_usage': {'total_usage': 2e9}}}
+    monkeypatch.setattr(shell_module, "_STATS_ONE_SHOT", True)
+    assert shell_module._container_cpu(Stats()) == 2.0
+    assert calls == [{'stream': False, 'one_shot': True}]
+    # Stats are not sampled twice on docker-py releases without one_shot
+    monkeypatch.setattr(shell_module, "_STATS_ONE_SHOT", False)
+    assert shell_module._container_cpu(Stats()) is None
+    assert len(calls) == 1
+
+
+def test_container_stream():
+    frames = [(b"fo", None), (None, b"warning\n"), (b"o\nbar\nba", None), (b"z\n", b"done\n")]
+    c = fake_container(frames)
+    stream = shell_module.ContainerStream(c, "cmd")
+    lines = iter(stream)
+    assert next(lines) == "foo"
+    # Frames are read as lines are consumed
+    assert c.client.api.consumed == 3
+    assert list(lines) == ["bar", "baz"]
+    assert stream.stderr == b"warning\ndone\n"
+    assert stream.exit_code == 0
+
+
+def test_container_stream_error(monkeypatch):
+    monkeypatch.setattr(shell_module, "STDERR_TAIL", 4)
+    c = fake_container([(b"foo\n", None), (None, b"error\n"), (None, b"oops\n")], exit_code=2)
+    with pytest.raises(sp.CalledProcessError) as e:
+        list(shell("cmd", container=c, iterable=True, stderr=None))
+    assert e.value.returncode == 2
+    # Only the tail of stderr is kept
+    assert e.value.stderr == b"ops\n"
+
+
+def test_container_stream_exit_lag():
+    c = fake_container([(b"foo\n", None)], exit_code=1, lag=3)
+    with pytest.raises(sp.CalledProcessError):
+        list(shell("cmd", container=c, iterable=True))
+
+
+def test_shell_container_limits(tmpdir, monkeypatch):
+    monkeypatch.setattr(jobserver, "_jobserver", jobserver.JobServer({'cores': 2}, path=str(tmpdir.join("js"))))
+    monkeypatch.setattr(jobserver._jobserver, "_cpus", [4, 5])
+    c = fake_container([(b"foo\n", None)])
+    assert list(shell("cmd", container=c, iterable=True, threads=2, limits=True)) == ["foo"]
+    assert c.limits == {'cpuset_cpus': "4,5", 'cpu_period': 100000, 'cpu_quota': 200000}
+    # Containers passed in are shared with later commands; not updated by default
+    c = fake_container([(b"foo\n", None)])
+    list(shell("cmd", container=c, iterable=True, threads=2))
+    assert c.limits == {}
+    c = fake_container([(b"foo\n", None)])
+    list(shell("cmd", container=c, iterable=True, limits=True))
+    # Constrained to the ngs threads without a reservation
+    assert c.limits == {'cpu_period': 100000, 'cpu_quota': 100000}
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import time
+from pytest_ngsfixtures.wm import benchmark, snakemake
+from pytest_ngsfixtures.wm.snakemake import run as snakemake_run
+
+SNAKEFILE = """
+rule all:
+    input: "s1.bam"
+
+rule align:
+    input: "{sample}.fastq.gz"
+    output: "{sample}.bam"
+    benchmark: repeat("benchmarks/{sample}.align.tsv", 2)
+    shell: "bwa mem {input} > {output}"
+
+rule sort:
+    output: "{sample}.sorted.bam"
+    shell: "samtools sort {input} > {output}"
+"""
+
+BENCHMARK = """s\th:m:s\tmax_rss\tmax_vms\tmax_uss\tmax_pss\tio_in\tio_out\tmean_load
+3.5\t0:00:03\t120.5\t300.0\t110.0\t115.0\t1.0\t2.0\t0.95
+4.0\t0:00:04\t100.0\t300.0\t90.0\t95.0\tNA\t2.0\t0.90
+"""
+
+
+def test_parse_rules():
+    assert benchmark.parse_rules(SNAKEFILE) == {'align': "benchmarks/{sample}.align.tsv"}
+
+
+def test_harvest(tmpdir):
+    tmpdir.mkdir("benchmarks").join("s1.align.tsv").write(BENCHMARK)
+    tmpdir.join("benchmarks", "s1.sort.tsv").write(BENCHMARK)
+    metadata = tmpdir.mkdir(".snakemake").mkdir("metadata")
+    metadata.join("czEuYmFt").write(json.dumps({'rule': "align", 'starttime': 100.0, 'endtime': 108.0}))
+    metadata.join("czEuc29ydGVkLmJhbQ==").write(json.dumps({'rule': "sort", 'starttime': 0.0, 'endtime': 1.0}))
+    metrics = benchmark.harvest(tmpdir, benchmark.parse_rules(SNAKEFILE))
+    assert metrics['align'] == {'jobs': 1, 's': 4.0, 'max_rss': 120.5, 'max_vms': 300.0,
+                                'io_in': 1.0, 'io_out': 2.0, 'mean_load': 0.95, 'wall_s': 8.0}
+    assert metrics['sort'] == {'jobs': 0, 'wall_s': 1.0}
+    # Files and jobs older than since are ignored
+    assert benchmark.harvest(tmpdir, {'align': "benchmarks/{sample}.align.tsv"},
+                             since=time.time() + 60) == {}
+    assert benchmark.check(metrics, "align", max_s=5, max_rss_mb=200) == []
+    assert len(benchmark.check(metrics, "align", max_s=3, max_rss_mb=100)) == 2
+    assert benchmark.check(metrics, "sort", max_s=5) == []
+    assert "benchmark directive" in benchmark.check(metrics, "sort", max_rss_mb=100)[0]
+
+
+def test_run_records_metrics(tmpdir, monkeypatch):
+    def fake_shell(cmd, **kwargs):
+        tmpdir.mkdir("benchmarks").join("s1.align.tsv").write(BENCHMARK)
+    monkeypatch.setattr(snakemake, "shell", fake_shell)
+    tmpdir.join("Snakefile").write(SNAKEFILE)
+    benchmark.metrics(reset=True)
+    snakemake_run(tmpdir.join("Snakefile"))
+    assert benchmark.metrics(reset=True)['align']['max_rss'] == 120.5
+    assert benchmark.metrics() == {}
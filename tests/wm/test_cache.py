@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import pytest
+from pytest_ngsfixtures.wm import cache, snakemake, benchmark
+from pytest_ngsfixtures.wm.snakemake import run as snakemake_run
+
+
+@pytest.fixture
+def output_cache(tmpdir_factory, monkeypatch):
+    outputs = cache.OutputCache(str(tmpdir_factory.mktemp("store")))
+    monkeypatch.setattr(cache, "_output_cache", outputs)
+    monkeypatch.setattr(cache, "_enabled", True)
+    return outputs
+
+
+def test_output_cache_store_restore(tmpdir, output_cache):
+    src = tmpdir.mkdir("src")
+    src.join("sub").mkdir().join("a.txt").write("a")
+    src.join("b.sh").write("b")
+    src.join("b.sh").chmod(0o755)
+    output_cache.store("key", str(src), ["sub/a.txt", "b.sh"])
+    dst = tmpdir.mkdir("dst")
+    assert not output_cache.restore("other", str(dst))
+    assert output_cache.restore("key", str(dst))
+    assert dst.join("sub", "a.txt").read() == "a"
+    assert os.access(str(dst.join("b.sh")), os.X_OK)
+
+
+def test_output_cache_prune(tmpdir, output_cache):
+    src = tmpdir.mkdir("src")
+    for i, key in enumerate(["old", "new"]):
+        src.join(key).write(key * 2**19)
+        output_cache.store(key, str(src), [key])
+        os.utime(output_cache._manifest(key), (i, i))
+    assert output_cache.size() == 2 * 3 * 2**19
+    output_cache.prune(max_mb=2)
+    dst = tmpdir.mkdir("dst")
+    assert not output_cache.restore("old", str(dst))
+    assert output_cache.restore("new", str(dst))
+    assert output_cache.size() == 3 * 2**19
+
+
+def test_run_cached(tmpdir, monkeypatch, output_cache):
+    calls = []
+
+    def fake_shell(cmd, **kwargs):
+        calls.append(cmd)
+        tmpdir.join("out.txt").write(tmpdir.join("in.txt").read().upper())
+
+    monkeypatch.setattr(snakemake, "shell", fake_shell)
+    tmpdir.join("Snakefile").write("rule all:\n    output: 'out.txt'\n")
+    tmpdir.join("in.txt").write("foo")
+    snakemake_run(tmpdir.join("Snakefile"), cache=True)
+    assert len(calls) == 1
+    tmpdir.join("out.txt").remove()
+    snakemake_run(tmpdir.join("Snakefile"), cache=True)
+    assert len(calls) == 1
+    assert tmpdir.join("out.txt").read() == "FOO"
+    # Changed input invalidates the key
+    tmpdir.join("out.txt").remove()
+    tmpdir.join("in.txt").write("bar")
+    snakemake_run(tmpdir.join("Snakefile"), cache=True)
+    assert len(calls) == 2
+    monkeypatch.setattr(cache, "_enabled", False)
+    snakemake_run(tmpdir.join("Snakefile"), cache=True)
+    assert len(calls) == 3
+
+
+def test_run_cached_execution(tmpdir, monkeypatch, output_cache):
+    calls = []
+
+    def fake_shell(cmd, **kwargs):
+        calls.append(kwargs.get("image"))
+        tmpdir.join("out.txt").write("foo")
+
+    monkeypatch.setattr(snakemake, "shell", fake_shell)
+    monkeypatch.setattr(snakemake, "_image_id", lambda image: "sha256:" + image)
+    tmpdir.join("Snakefile").write("rule all:\n    output: 'out.txt'\n")
+    snakemake_run(tmpdir.join("Snakefile"), cache=True)
+    tmpdir.join("out.txt").remove()
+    # Runs in an image are not restored from local runs
+    snakemake_run(tmpdir.join("Snakefile"), cache=True, image="snakemake")
+    assert calls == [None, "snakemake"]
+    tmpdir.join("out.txt").remove()
+    snakemake_run(tmpdir.join("Snakefile"), cache=True, image="snakemake")
+    assert len(calls) == 2
+
+
+def test_run_cached_benchmark(tmpdir, monkeypatch, output_cache):
+    def fake_shell(cmd, **kwargs):
+        tmpdir.join("out.txt").write("foo")
+        tmpdir.join("bench.tsv").write("s\tmax_rss\n2.5\t100.0\n")
+
+    monkeypatch.setattr(snakemake, "shell", fake_shell)
+    tmpdir.join("Snakefile").write("rule all:\n    output: 'out.txt'\n    benchmark: 'bench.tsv'\n")
+    snakemake_run(tmpdir.join("Snakefile"), cache=True)
+    assert benchmark.metrics(reset=True)["all"]["s"] == 2.5
+    tmpdir.join("out.txt").remove()
+    tmpdir.join("bench.tsv").remove()
+    # Metrics of cache-served runs come from the restored benchmark files
+    snakemake_run(tmpdir.join("Snakefile"), cache=True)
+    assert tmpdir.join("out.txt").read() == "foo"
+    assert benchmark.metrics(reset=True)["all"]["max_rss"] == 100.0
@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import os
+import sys
 import py
+import types
+import contextlib
+import pathlib
 import pytest
-from pytest_ngsfixtures.wm.snakemake import snakefile, run as snakemake_run
+import subprocess as sp
+from pytest_ngsfixtures.wm import snakemake
+from pytest_ngsfixtures.wm.snakemake import snakefile, run as snakemake_run, _directory
 
 
 @pytest.mark.snakefile(numbered=True)
@@ -28,3 +35,256 @@ def test_image_wf(snakefile, snakemake_image, image_args):
                   **image_args)
     files = [x.basename for x in py.path.local(snakefile.dirname).listdir()]
     assert "foo.txt" in files
+
+
+@pytest.mark.snakefile(numbered=True)
+@pytest.mark.snakemake
+def test_image_wf_mounts(snakefile, snakemake_image):
+    snakemake_run(snakefile, image=snakemake_image, mounts=True,
+                  user="{}:{}".format(pytest.uid, pytest.gid))
+    files = [x.basename for x in py.path.local(snakefile.dirname).listdir()]
+    assert "foo.txt" in files
+
+
+def test_directory():
+    assert _directory(["-d /tmp/foo", "-k"]) == "/tmp/foo"
+    assert _directory(["--directory=/tmp/foo"]) == "/tmp/foo"
+    assert _directory(["-j 2"]) is None
+
+
+def test_run_api_backend(tmpdir, monkeypatch):
+    calls = []
+
+    def main(argv):
+        calls.append(argv)
+        os.chdir(argv[argv.index("-d") + 1])
+        py.path.local("foo.txt").write("foo")
+        sys.exit(0 if "all" in argv else 1)
+    fake = types.ModuleType("snakemake")
+    fake.main = main
+    monkeypatch.setitem(sys.modules, "snakemake", fake)
+    monkeypatch.setitem(sys.modules, "snakemake.cli", None)
+    snakefile = tmpdir.join("Snakefile")
+    cwd = os.getcwd()
+    snakemake_run(snakefile, backend="api")
+    assert calls == [["-s", str(snakefile), "all", "-d", str(tmpdir)]]
+    assert tmpdir.join("foo.txt").exists()
+    assert os.getcwd() == cwd
+    with pytest.raises(sp.CalledProcessError):
+        snakemake_run(snakefile, target="foo.txt", backend="api")
+    assert os.getcwd() == cwd
+    # Output redirection is not dropped, but handled by the subprocess backend
+    cmds = []
+    monkeypatch.setattr(snakemake, "shell", lambda cmd, **kwargs: cmds.append(kwargs))
+    out = tmpdir.join("out.txt")
+    with open(str(out), "w") as fh:
+        snakemake_run(snakefile, backend="api", stdout=fh, stderr=fh)
+        assert len(calls) == 2 and cmds[0]["stdout"] is fh and cmds[0]["stderr"] is fh
+
+
+DRYRUN_OUTPUT = """Building DAG of jobs...
+Job counts:
+\tcount\tjobs
+\t1\tall
+\t2\tbwa_mem
+\t3
+
+rule bwa_mem:
+    input: ref.fa, s1_1.fastq.gz, s1_2.fastq.gz
+    output: s1.bam
+    jobid: 1
+    reason: Missing output files: s1.bam
+    wildcards: sample=s1
+
+localrule all:
+    input: s1.bam
+    jobid: 0
+    reason: Input files updated by another job: s1.bam
+
+Job counts:
+\tcount\tjobs
+\t1\tall
+\t1\tbwa_mem
+\t2
+This was a dry-run (flag -n). The order of jobs does not reflect the order of execution.
+"""
+
+
+def test_parse_dryrun():
+    jobs = snakemake.parse_dryrun(DRYRUN_OUTPUT)
+    assert [j.rule for j in jobs] == ["bwa_mem", "all"]
+    assert jobs[0].input == ["ref.fa", "s1_1.fastq.gz", "s1_2.fastq.gz"]
+    assert jobs[0].output == ["s1.bam"]
+    assert jobs[0].wildcards == {'sample': "s1"}
+    assert jobs[1].jobid == 0 and jobs[1].output == []
+
+
+def test_dryrun_cached(tmpdir, monkeypatch):
+    calls = []
+
+    def run(snakefile, **kwargs):
+        calls.append(kwargs)
+        return DRYRUN_OUTPUT
+    monkeypatch.setattr(snakemake, "run", run)
+    monkeypatch.setattr(snakemake, "CACHE_DIR", pathlib.Path(str(tmpdir.join("cache"))))
+    monkeypatch.setattr(snakemake, "_dryruns", {})
+    wf = tmpdir.mkdir("wf")
+    sf = wf.join("Snakefile")
+    sf.write('include: "rules.smk"\n')
+    wf.join("rules.smk").write("rule a:\n")
+    jobs = snakemake.dryrun(sf)
+    assert "-n" in calls[0]["options"]
+    assert snakemake.dryrun(sf) == jobs
+    assert len(calls) == 1
+    # Persistent cache
+    monkeypatch.setattr(snakemake, "_dryruns", {})
+    assert snakemake.dryrun(sf) == jobs
+    assert len(calls) == 1
+    # Included files, the input layout and options are part of the key
+    wf.join("rules.smk").write("rule b:\n")
+    snakemake.dryrun(sf)
+    wf.join("s1_1.fastq.gz").write("")
+    snakemake.dryrun(sf)
+    snakemake.dryrun(sf, options=["-k"])
+    assert len(calls) == 4
+    snakemake.dryrun(sf, cache=False)
+    assert len(calls) == 5
+
+
+def test_run_targets(tmpdir, monkeypatch):
+    cmds = []
+    dryrun_output = DRYRUN_OUTPUT.replace("    output: s1.bam\n", "    output: s1.bam, s2.bam\n")
+
+    def fake_shell(cmd, **kwargs):
+        cmds.append(cmd)
+        if kwargs.get("read"):
+            return dryrun_output
+        tmpdir.join("s1.bam").write("")
+        raise sp.CalledProcessError(1, cmd)
+    # Number of threads set with --ngs-threads
+    fake_shell._threads = 4
+    monkeypatch.setattr(snakemake, "shell", fake_shell)
+    monkeypatch.setattr(snakemake, "CACHE_DIR", pathlib.Path(str(tmpdir.join("cache"))))
+    monkeypatch.setattr(snakemake, "_dryruns", {})
+    tmpdir.join("Snakefile").write("rule all:\n    input: 's1.bam'\n\n"
+                                   "rule bwa_mem:\n    output: '{sample}.bam'\n")
+    # File targets are run without planning
+    results = snakemake_run(tmpdir.join("Snakefile"), target=["s1.bam", "s2.bam"])
+    assert len(cmds) == 1
+    assert results["s2.bam"] == (False, [str(tmpdir.join("s2.bam"))])
+    # Rule targets are planned
+    del cmds[:]
+    results = snakemake_run(tmpdir.join("Snakefile"), target=["s1.bam", "bwa_mem", "all"])
+    assert len(cmds) == 2
+    assert "bwa_mem all" in cmds[0] and "s1.bam" not in cmds[0]
+    assert "s1.bam bwa_mem all" in cmds[1]
+    assert "-j 4" in cmds[1] and "--keep-going" in cmds[1]
+    assert results["s1.bam"] == (True, [str(tmpdir.join("s1.bam"))])
+    assert results["bwa_mem"].outputs == [str(tmpdir.join("s1.bam")), str(tmpdir.join("s2.bam"))]
+    assert not results["bwa_mem"].success
+    assert results["all"] == (False, [])
+    with pytest.raises(ValueError):
+        snakemake_run(tmpdir.join("Snakefile"), target=["s1.bam"], iterable=True)
+
+
+def test_dryrun_key_relocatable(tmpdir):
+    keys = []
+    for i, name in enumerate(["a", "b"]):
+        wf = tmpdir.mkdir(name)
+        wf.join("Snakefile").write('include: "rules.smk"\n')
+        wf.join("rules.smk").write("rule a:\n")
+        wf.join("s1_1.fastq.gz").write("foo")
+        os.utime(str(wf.join("s1_1.fastq.gz")), (i, i))
+        keys.append(snakemake._dryrun_key(wf.join("Snakefile"), "all", ["-d", str(wf)]))
+    assert keys[0] == keys[1]
+    tmpdir.join("b", "s1_1.fastq.gz").write("bar")
+    assert snakemake._dryrun_key(tmpdir.join("b", "Snakefile"), "all",
+                                 ["-d", str(tmpdir.join("b"))]) != keys[0]
+
+
+def test_dryrun_key_large_files(tmpdir, monkeypatch):
+    monkeypatch.setattr(snakemake, "DIGEST_MAX_BYTES", 8)
+    data = tmpdir.join("data.fastq.gz")
+    data.write("foo" * 4)
+    keys = []
+    for name in ("a", "b"):
+        wf = tmpdir.mkdir(name)
+        wf.join("Snakefile").write("rule a:\n")
+        wf.join("s1_1.fastq.gz").mksymlinkto(data)
+        keys.append(snakemake._dryrun_key(wf.join("Snakefile"), "all", ["-d", str(wf)]))
+    # Linked fixtures are keyed on their target
+    assert keys[0] == keys[1]
+    wf = tmpdir.join("a")
+    wf.join("s2_1.fastq.gz").write("foo" * 4)
+    opened = []
+
+    def _open(path, *args, **kwargs):
+        opened.append(str(path))
+        return open(path, *args, **kwargs)
+    monkeypatch.setattr(snakemake, "open", _open, raising=False)
+    key = snakemake._dryrun_key(wf.join("Snakefile"), "all", ["-d", str(wf)])
+    # Large files are not read, but keyed on their modification time
+    assert opened and str(wf.join("s2_1.fastq.gz")) not in opened
+    os.utime(str(wf.join("s2_1.fastq.gz")), (0, 0))
+    assert snakemake._dryrun_key(wf.join("Snakefile"), "all", ["-d", str(wf)]) != key
+
+
+@pytest.fixture
+def shared_prefixes(tmpdir, monkeypatch):
+    monkeypatch.setattr(snakemake, "CONDA_PREFIX", pathlib.Path(str(tmpdir.join("conda"))))
+    monkeypatch.setattr(snakemake, "SINGULARITY_PREFIX", pathlib.Path(str(tmpdir.join("singularity"))))
+
+
+def test_run_shared_prefixes(tmpdir, monkeypatch, shared_prefixes):
+    cmds = []
+    monkeypatch.setattr(snakemake, "shell", lambda cmd, **kwargs: cmds.append(cmd))
+    snakemake_run(tmpdir.join("Snakefile"), options=["--use-conda", "--use-singularity"])
+    assert "--conda-prefix {}".format(snakemake.CONDA_PREFIX) in cmds[0]
+    assert "--singularity-prefix {}".format(snakemake.SINGULARITY_PREFIX) in cmds[0]
+    snakemake_run(tmpdir.join("Snakefile"), options=["--use-conda", "--conda-prefix /tmp"])
+    assert cmds[1].count("--conda-prefix") == 1
+    snakemake_run(tmpdir.join("Snakefile"))
+    assert "--conda-prefix" not in cmds[2]
+
+
+def test_create_conda_envs(tmpdir, monkeypatch, shared_prefixes):
+    calls = []
+    monkeypatch.setattr(snakemake, "run", lambda snakefile, **kwargs: calls.append((snakefile, kwargs)))
+    wf = tmpdir.mkdir("wf")
+    wf.join("env.yaml").write("dependencies:\n  - samtools\n")
+    for name in ("a", "b"):
+        wf.join(name).write('rule {}:\n    conda: "env.yaml"\n'.format(name))
+    wf.join("c").write('rule c:\n    shell: "true"\n')
+    results = snakemake.create_conda_envs([wf.join(x) for x in "abc"])
+    assert results == {str(wf.join(x)): None for x in "abc"}
+    # The environment shared by a and b is only created once
+    assert len(calls) == 1
+    options = calls[0][1]["options"]
+    assert "--conda-create-envs-only" in options
+    # The workflow directory is not locked
+    assert "--nolock" in options and "-d" not in options
+    snakemake.create_conda_envs([wf.join("a")])
+    assert len(calls) == 1
+
+
+def test_run_creates_conda_envs(tmpdir, monkeypatch, shared_prefixes):
+    cmds = []
+    monkeypatch.setattr(snakemake, "shell", lambda cmd, **kwargs: cmds.append(cmd))
+    locked = []
+    env_locks = snakemake._env_locks
+
+    @contextlib.contextmanager
+    def _env_locks(hashes):
+        with env_locks(hashes) as lockdir:
+            locked.append(hashes)
+            yield lockdir
+    monkeypatch.setattr(snakemake, "_env_locks", _env_locks)
+    tmpdir.join("env.yaml").write("dependencies:\n  - samtools\n")
+    tmpdir.join("Snakefile").write('rule a:\n    conda: "env.yaml"\n')
+    snakemake_run(tmpdir.join("Snakefile"), options=["--use-conda"])
+    # Missing environments are created under their locks first
+    assert len(cmds) == 2 and len(locked) == 1
+    assert "--conda-create-envs-only" in cmds[0] and "--nolock" in cmds[0]
+    assert "--conda-create-envs-only" not in cmds[1]
+    snakemake_run(tmpdir.join("Snakefile"), options=["--use-conda"])
+    assert len(cmds) == 3 and len(locked) == 1